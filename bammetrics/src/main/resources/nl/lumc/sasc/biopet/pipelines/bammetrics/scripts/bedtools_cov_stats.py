@@ -1,4 +1,4 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python
 #
 # Biopet is built on top of GATK Queue for building bioinformatic
 # pipelines. It is mainly intended to support LUMC SHARK cluster which is running
@@ -28,10 +28,23 @@ Counts for bases that are not covered (0x coverage) are shown in lighter
 shade. The median, quartile, and whiskers values shown in the boxplot are
 still computed from the complete data set (0x coverage included).
 
+Instead of coverageBed output, the BAM file and the target BED file can be
+given (--bam / --targets). The per-base depth over each target is then
+computed from the indexed BAM file with pysam, with the targets split over
+a pool of worker processes, and goes straight into the coverage histograms.
+By default the numbers are the same as those of `bedtools coverage -d`:
+every mapped read counts over its whole aligned span.
+
+With --gaps, the runs of target bases with a depth below one or more
+thresholds are written to a BED file in the same pass, with their mean
+depth. With --bedgraph, the mean depth of the target bases in each bin of
+--bin-size bases is written as a bedGraph, e.g. to build a bigWig from.
+
 Requirements:
-    * Python == 2.7.x
+    * Python 2.7 or >= 3.4
     * Matplotlib >= 1.3.0
     * Numpy >= 1.8.0
+    * Pysam (only with --bam)
 
 Copyright (c) 2013 Wibowo Arindrarto <w.arindrarto@lumc.nl>
 Copyright (c) 2013 LUMC Sequencing Analysis Support Core <sasc@lumc.nl>
@@ -49,24 +62,22 @@ import collections
 import itertools
 import json
 import locale
+import multiprocessing
 import os
 import sys
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.gridspec as gs
-import matplotlib.pyplot as plt
-import matplotlib.ticker as tkr
-import numpy as np
+import biopet_io
+import biopet_runtime
 
 
 BLUE = '#2166AC'
 RED = '#1A9850'
 GREEN = '#D6604D'
 
-locale.setlocale(locale.LC_ALL, '')
-group_digits = lambda x, pos: locale.format('%d', x, grouping=True)
-major_formatter = tkr.FuncFormatter(group_digits)
+group_digits = lambda x, pos: locale.format_string('%d', x, grouping=True)
+
+# maximum size of the pieces targets are split into in --bam mode
+WINDOW_SIZE = 1000000
 
 
 def cachedproperty(func):
@@ -97,19 +108,30 @@ class Coverage(object):
         """
         assert cvg_list
         counter = collections.Counter()
-        total_bases, nonzero_bases = 0, 0
         for cvg in cvg_list:
             counter[cvg] += 1
-            total_bases += 1
-            if cvg > 0:
-                nonzero_bases += 1
+        self._set_counter(counter)
+
+    @classmethod
+    def from_histogram(cls, histogram):
+        """Create from a mapping of coverage to the number of bases.
+
+        :param histogram: number of bases per coverage value
+        :type histogram: dict
 
+        """
+        assert histogram
+        coverage = cls.__new__(cls)
+        coverage._set_counter(collections.Counter(histogram))
+        return coverage
+
+    def _set_counter(self, counter):
         self._counter = counter
-        self.total_bases = total_bases
-        self.nonzero_bases = nonzero_bases
+        self.total_bases = sum(counter.values())
+        self.nonzero_bases = self.total_bases - counter.get(0, 0)
 
     def __iter__(self):
-        return self._counter.iteritems()
+        return iter(self._counter.items())
 
     def __repr__(self):
         return "{0}(...)".format(self.__class__.__name__)
@@ -137,7 +159,27 @@ class Coverage(object):
     @cachedproperty
     def median(self):
         """Median coverage."""
-        return np.percentile(self.cov_counts, 50)
+        return self.percentile(50)
+
+    def percentile(self, q):
+        """Percentile of the coverage, interpolated like numpy.percentile.
+
+        Computed from the coverage histogram, so the coverage of each base
+        does not have to be expanded into a list.
+        """
+        rank = (self.total_bases - 1) * q / 100.0
+        lower = int(rank)
+        fraction = rank - lower
+        lower_value, upper_value = None, None
+        seen = 0
+        for cvg in sorted(self._counter):
+            seen += self._counter[cvg]
+            if lower_value is None and seen > lower:
+                lower_value = cvg
+            if seen > lower + 1 or (seen > lower and fraction == 0):
+                upper_value = cvg
+                break
+        return float(lower_value + (upper_value - lower_value) * fraction)
 
     @cachedproperty
     def cov_counts(self):
@@ -184,6 +226,13 @@ class Coverage(object):
         :type out_img: str
 
         """
+        plt = biopet_runtime.pyplot()
+        gs = biopet_runtime.lazy_import('matplotlib.gridspec')
+        tkr = biopet_runtime.lazy_import('matplotlib.ticker')
+        np = biopet_runtime.lazy_import('numpy')
+        locale.setlocale(locale.LC_ALL, '')
+        major_formatter = tkr.FuncFormatter(group_digits)
+
         plt.figure(figsize=(8, 8))
         grids = gs.GridSpec(2, 1, height_ratios=[5, 1])
 
@@ -191,7 +240,7 @@ class Coverage(object):
 
         if title is None:
             title = ['Coverage Plot']
-        elif isinstance(title, basestring):
+        elif not isinstance(title, list):
             title = [title]
         t = plt.title('\n'.join(title), fontsize=20)
         t.set_y(1.05)
@@ -253,45 +302,303 @@ class Coverage(object):
             plt.savefig(out_img, bbox_inches='tight')
 
 
-if __name__ == '__main__':
-
-    usage = __doc__.split('\n\n\n')
-    parser = argparse.ArgumentParser(
-            formatter_class=argparse.RawDescriptionHelpFormatter,
-            description=usage[0], epilog=usage[1])
+def read_targets(path, window=WINDOW_SIZE):
+    """Read a BED file as (target number, (chrom, start, end)) pieces of at
+    most window bases."""
+    pieces = []
+    with biopet_io.open_input(path) as handle:
+        target = 0
+        for line in handle:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            cols = line.split('\t')
+            chrom, start, end = cols[0], int(cols[1]), int(cols[2])
+            for piece_start in range(start, end, window):
+                pieces.append((target, (chrom, piece_start, min(end, piece_start + window))))
+            target += 1
+    return pieces
+
+
+def gap_runs(depth, start, thresholds):
+    """Runs of bases with a depth below each of the thresholds.
+
+    :param depth: per-base depth of a window
+    :type depth: numpy array
+    :param start: position of the first base of the window
+    :type start: int
+    :returns: per threshold a list of (start, end, depth sum) of the runs
+    """
+    np = biopet_runtime.lazy_import('numpy')
+    cumulative = np.concatenate(([0], np.cumsum(depth)))
+    runs = []
+    for threshold in thresholds:
+        below = np.concatenate(([False], depth < threshold, [False]))
+        edges = np.flatnonzero(below[1:] != below[:-1])
+        starts, ends = edges[::2], edges[1::2]
+        runs.append(list(zip((starts + start).tolist(), (ends + start).tolist(),
+                             (cumulative[ends] - cumulative[starts]).tolist())))
+    return runs
+
+
+class GapWriter(object):
+
+    """Writes runs of bases below depth thresholds as BED lines: chrom,
+    start, end, mean depth and threshold.
+
+    Runs of consecutive windows of the same target are joined. Only the
+    open run per threshold is kept, so memory does not grow with the
+    number of bases or runs; runs are written in the order they end.
+    """
+
+    def __init__(self, handle, thresholds):
+        self.handle = handle
+        self.thresholds = thresholds
+        self._target = None
+        self._open = {}
+
+    def add(self, target, chrom, runs):
+        """Add the runs (see gap_runs) of the next window of a target."""
+        if target != self._target:
+            self.flush()
+            self._target = target
+        for threshold, threshold_runs in zip(self.thresholds, runs):
+            for start, end, total in threshold_runs:
+                current = self._open.get(threshold)
+                if current is not None and current[2] == start:
+                    current[2] = end
+                    current[3] += total
+                    continue
+                if current is not None:
+                    self._write(threshold, current)
+                self._open[threshold] = [chrom, start, end, total]
+
+    def flush(self):
+        for threshold in self.thresholds:
+            if threshold in self._open:
+                self._write(threshold, self._open.pop(threshold))
+
+    def _write(self, threshold, run):
+        chrom, start, end, total = run
+        self.handle.write('{0}\t{1}\t{2}\t{3:.2f}\t{4}\n'.format(
+            chrom, start, end, float(total) / (end - start), threshold))
+
+
+def window_bins(depth, start, size):
+    """Depth sum and number of bases per bin of the bases of a window.
+
+    :returns: (sums, counts) arrays; the first element is the bin of start
+    """
+    np = biopet_runtime.lazy_import('numpy')
+    bins = (np.arange(len(depth)) + start % size) // size
+    return np.bincount(bins, weights=depth), np.bincount(bins)
+
+
+class BinWriter(object):
+
+    """Writes the mean depth per bin of the genome as bedGraph lines:
+    chrom, start, end and mean depth, where a bin is limited to the target
+    bases in it. A bin never spans a gap between targets: it is split into
+    one line per contiguous stretch of target bases.
+
+    The windows must come in sorted order (by contig, then position), as
+    they do for sorted targets. Bins before the current window are written
+    out, so only the bins of the current stretch of targets are kept.
+    """
+
+    def __init__(self, handle, size):
+        self.handle = handle
+        self.size = size
+        self._chrom = None
+        self._end = None
+        self._bins = {}
+
+    def add(self, chrom, start, end, bins):
+        """Add the bins (see window_bins) of the window chrom:start-end."""
+        if chrom != self._chrom or start > self._end:
+            self.flush()
+            self._chrom = chrom
+            self._end = end
+        else:
+            self._write_before(start // self.size)
+            self._end = max(self._end, end)
+        first = start // self.size
+        sums, counts = bins
+        for i, (total, count) in enumerate(zip(sums.tolist(), counts.tolist())):
+            if not count:
+                continue
+            index = first + i
+            bin_start = max(index * self.size, start)
+            bin_end = min((index + 1) * self.size, end)
+            current = self._bins.get(index)
+            if current is None:
+                self._bins[index] = [total, count, bin_start, bin_end]
+            else:
+                current[0] += total
+                current[1] += count
+                current[2] = min(current[2], bin_start)
+                current[3] = max(current[3], bin_end)
+
+    def flush(self):
+        self._write_before(None)
+
+    def _write_before(self, limit):
+        for index in sorted(self._bins):
+            if limit is not None and index >= limit:
+                break
+            total, count, start, end = self._bins.pop(index)
+            self.handle.write('{0}\t{1}\t{2}\t{3:.2f}\n'.format(
+                self._chrom, start, end, float(total) / count))
+
+
+_bam = None
+
+
+def _open_bam(path):
+    global _bam
+    _bam = biopet_runtime.lazy_import('pysam').AlignmentFile(path, 'rb')
+
+
+def region_depth(region, exclude_flags=0x4, min_mapq=0):
+    """Per-base depth over a region of the open BAM file.
+
+    Every read that is not excluded by its flags or mapping quality counts
+    over its whole aligned span (deletions and skipped regions included),
+    like `bedtools coverage -d` does.
+
+    :returns: the depth as an array with one value per base of the region
+    """
+    np = biopet_runtime.lazy_import('numpy')
+    chrom, start, end = region
+    length = end - start
+    starts, ends = [], []
+    try:
+        reads = _bam.fetch(chrom, start, end)
+    except ValueError:
+        # contig not in the bam file: nothing covers the region
+        reads = []
+    for read in reads:
+        if read.is_unmapped or read.flag & exclude_flags \
+                or read.mapping_quality < min_mapq:
+            continue
+        starts.append(max(read.reference_start, start) - start)
+        ends.append(min(read.reference_end, end) - start)
+    steps = np.bincount(np.array(starts, dtype=np.int64), minlength=length + 1) - \
+        np.bincount(np.array(ends, dtype=np.int64), minlength=length + 1)
+    return np.cumsum(steps[:length])
+
+
+def _region_job(job):
+    """Pool worker: depth histogram, gap runs and bins of one target piece."""
+    np = biopet_runtime.lazy_import('numpy')
+    target, region, exclude_flags, min_mapq, gap_thresholds, bin_size = job
+    depth = region_depth(region, exclude_flags, min_mapq)
+    runs = gap_runs(depth, region[1], gap_thresholds) if gap_thresholds else None
+    bins = window_bins(depth, region[1], bin_size) if bin_size else None
+    return target, region, np.bincount(depth), runs, bins
+
+
+def bam_coverages(bam, targets, processes=1, exclude_flags=0x4, min_mapq=0,
+                  gaps=None, bins=None):
+    """Coverage objects per contig and for all targets ('_all') of a BAM file.
+
+    :param gaps: writer for the low coverage runs, if wanted
+    :type gaps: GapWriter
+    :param bins: writer for the binned depth, if wanted
+    :type bins: BinWriter
+    """
+    thresholds = gaps.thresholds if gaps is not None else ()
+    bin_size = bins.size if bins is not None else None
+    jobs = [(target, region, exclude_flags, min_mapq, thresholds, bin_size)
+            for target, region in read_targets(targets)]
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)), _open_bam, (bam,))
+        # in order, so the runs of a target can be joined over its pieces
+        # and the bins are written sorted
+        results = pool.imap(_region_job, jobs, chunksize=16)
+    else:
+        pool = None
+        _open_bam(bam)
+        results = (_region_job(job) for job in jobs)
+
+    histograms = {}
+
+    def add(name, histogram):
+        current = histograms.get(name)
+        if current is None or len(current) < len(histogram):
+            histogram = histogram.copy()
+            if current is not None:
+                histogram[:len(current)] += current
+            histograms[name] = histogram
+        else:
+            current[:len(histogram)] += histogram
+
+    try:
+        for target, region, histogram, runs, region_bins in results:
+            chrom = region[0]
+            add(chrom, histogram)
+            add('_all', histogram)
+            if gaps is not None:
+                gaps.add(target, chrom, runs)
+            if bins is not None:
+                bins.add(chrom, region[1], region[2], region_bins)
+            biopet_runtime.add_records(int(histogram.sum()))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for writer in (gaps, bins):
+        if writer is not None:
+            writer.flush()
 
-    parser.add_argument('input', type=str, help='Path to input file '
-            '(coverageBed output) or \'-\' for stdin')
-    parser.add_argument('--plot', dest='plot', type=str,
-            help='Path to output PNG file')
-    parser.add_argument('--min-cov-show', dest='min_cov_ok', type=int,
-            default=6, help='Minimum coverage to show in bar graph')
-    parser.add_argument('--max-percentile-show', dest='max_pct_show', type=int,
-            default=98, help='Maximum percentile to show in bar graph')
-    parser.add_argument('--title', dest='title', type=str,
-            default='Coverage Plot', help='Plot title')
-    parser.add_argument('--subtitle', dest='subtitle', type=str, help='Plot subtitle')
+    coverages = {}
+    for name, histogram in histograms.items():
+        coverages[name] = Coverage.from_histogram(
+            dict((int(cvg), int(count)) for cvg, count in enumerate(histogram) if count))
+    return coverages
 
-    args = parser.parse_args()
 
-    if args.input == '-':
-        instream = sys.stdin
-    else:
-        instream = open(args.input, 'r')
-
-    title = [args.title]
-    if args.subtitle is None:
-        title.append("'" + args.input + "'")
-    else:
-        title.append(args.subtitle)
+def text_coverages(instream, gaps=None, bins=None):
+    """Coverage objects per contig and for all positions ('_all') of
+    coverageBed -d output.
 
+    :param gaps: writer for the low coverage runs, if wanted
+    :type gaps: GapWriter
+    :param bins: writer for the binned depth, if wanted
+    :type bins: BinWriter
+    """
     coverages = {}
     all_covs, cur_covs = [], []
     cur_chrom, prev_chrom = None, None
+    # window of consecutive bases of one target, for the gaps and bins
+    window, window_target, window_start = [], None, None
+    windowed = gaps is not None or bins is not None
+
+    def flush_window():
+        if window:
+            np = biopet_runtime.lazy_import('numpy')
+            depth = np.array(window)
+            chrom = window_target[0]
+            if gaps is not None:
+                gaps.add(window_target, chrom,
+                         gap_runs(depth, window_start, gaps.thresholds))
+            if bins is not None:
+                bins.add(chrom, window_start, window_start + len(depth),
+                         window_bins(depth, window_start, bins.size))
+            del window[:]
+
     for line in (l.strip() for l in instream):
         cols = line.split('\t')
         cur_chrom = cols[0]
         cvg = int(cols[-1])
+        if windowed:
+            # target columns, then the 1-based position within the target
+            target = tuple(cols[:-2])
+            pos = int(cols[1]) + int(cols[-2]) - 1
+            if target != window_target or pos != window_start + len(window) \
+                    or len(window) >= WINDOW_SIZE:
+                flush_window()
+                window_target, window_start = target, pos
+            window.append(cvg)
         # coverage for all positions
         all_covs.append(cvg)
         # coverage per chromosome
@@ -303,18 +610,97 @@ if __name__ == '__main__':
         cur_covs.append(cvg)
     # also append the last chromosome from the file
     coverages[cur_chrom] = cur_covs
+    if windowed:
+        flush_window()
+        for writer in (gaps, bins):
+            if writer is not None:
+                writer.flush()
 
     coverages['_all'] = all_covs
+    biopet_runtime.add_records(len(all_covs))
 
     for cname, clist in coverages.items():
         coverages[cname] = Coverage(clist)
+    return coverages
+
+
+if __name__ == '__main__':
+
+    usage = __doc__.split('\n\n\n')
+    parser = argparse.ArgumentParser(
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            description=usage[0], epilog=usage[1])
+
+    parser.add_argument('input', type=str, nargs='?', help='Path to input file '
+            '(coverageBed output, optionally gzip / BGZF compressed) or '
+            '\'-\' for stdin')
+    parser.add_argument('--bam', dest='bam', type=str,
+            help='Path to indexed BAM file to compute the coverage from, '
+            'instead of the input file')
+    parser.add_argument('--targets', dest='targets', type=str,
+            help='Path to BED file with the targets (with --bam)')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=1,
+            help='Number of worker processes (with --bam)')
+    parser.add_argument('--exclude-flags', dest='exclude_flags', type=int,
+            default=0x4, help='Skip reads with any of these flags set (with '
+            '--bam); the default, unmapped, matches bedtools')
+    parser.add_argument('--min-mapq', dest='min_mapq', type=int, default=0,
+            help='Skip reads with a lower mapping quality (with --bam)')
+    parser.add_argument('--gaps', dest='gaps', type=str,
+            help='Path to output BED file with the runs of bases below the '
+            'gap thresholds: chrom, start, end, mean depth and threshold')
+    parser.add_argument('--gap-threshold', dest='gap_thresholds', type=int,
+            action='append', help='Depth below which bases are reported in '
+            'the gaps file; can be given multiple times (default: 20)')
+    parser.add_argument('--bedgraph', dest='bedgraph', type=str,
+            help='Path to output bedGraph file with the mean depth per bin; '
+            'the targets must be sorted')
+    parser.add_argument('--bin-size', dest='bin_size', type=int,
+            default=1000, help='Size of the bins of the bedGraph file')
+    parser.add_argument('--plot', dest='plot', type=str,
+            help='Path to output PNG file')
+    parser.add_argument('--min-cov-show', dest='min_cov_ok', type=int,
+            default=6, help='Minimum coverage to show in bar graph')
+    parser.add_argument('--max-percentile-show', dest='max_pct_show', type=int,
+            default=98, help='Maximum percentile to show in bar graph')
+    parser.add_argument('--title', dest='title', type=str,
+            default='Coverage Plot', help='Plot title')
+    parser.add_argument('--subtitle', dest='subtitle', type=str, help='Plot subtitle')
 
-    if args.input != '-':
+    args = parser.parse_args()
+    if (args.bam is None) == (args.input is None):
+        parser.error('give either an input file or --bam')
+    if args.bam is not None and args.targets is None:
+        parser.error('--bam needs --targets')
+    biopet_runtime.init(__file__)
+
+    title = [args.title]
+    if args.subtitle is None:
+        title.append("'" + (args.input or args.bam) + "'")
+    else:
+        title.append(args.subtitle)
+
+    handles, gaps, bins = [], None, None
+    if args.gaps is not None:
+        handles.append(biopet_io.open_output(args.gaps))
+        gaps = GapWriter(handles[-1], sorted(set(args.gap_thresholds or [20])))
+    if args.bedgraph is not None:
+        handles.append(biopet_io.open_output(args.bedgraph))
+        bins = BinWriter(handles[-1], args.bin_size)
+
+    if args.bam is not None:
+        coverages = bam_coverages(args.bam, args.targets, args.threads,
+                args.exclude_flags, args.min_mapq, gaps=gaps, bins=bins)
+    else:
+        instream = biopet_io.open_input(args.input)
+        coverages = text_coverages(instream, gaps=gaps, bins=bins)
         instream.close()
+    for handle in handles:
+        handle.close()
 
     if args.plot is not None:
         coverages['_all'].plot(min_cov_ok=args.min_cov_ok, percentile_show=args.max_pct_show,
                 title=title, out_img=args.plot)
 
     stats = {'coverage': {k: v.get_quick_stats() for k, v in coverages.items()}}
-    json.dump(stats, sys.stdout, sort_keys=True, indent=4, separators=(',', ': '))
\ No newline at end of file
+    json.dump(stats, sys.stdout, sort_keys=True, indent=4, separators=(',', ': '))
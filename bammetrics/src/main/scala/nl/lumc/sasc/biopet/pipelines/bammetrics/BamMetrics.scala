@@ -48,6 +48,10 @@ class BamMetrics(val parent: Configurable)
   @Input(required = false)
   var deps: List[File] = Nil
 
+  /** Compute the coverage stats of the regions directly from the bam file, without bedtools */
+  @Argument(required = false)
+  var coverageFromBam: Boolean = config("coverage_stats_from_bam", default = false)
+
   override def defaults = Map("bedtoolscoverage" -> Map("sorted" -> true))
 
   /** returns files to store in summary */
@@ -202,12 +206,18 @@ class BamMetrics(val parent: Configurable)
           sorter.output
         }
       )
-      val bedCov = BedtoolsCoverage(this, sortedBed, inputBam, depth = true)
       val covStats =
         CoverageStats(this, targetDir, inputBam.getName.stripSuffix(".bam") + ".coverage")
       covStats.title = Some("Coverage Plot")
       covStats.subTitle = Some(s"for file '$targetName.bed'")
-      add(bedCov | covStats)
+      if (coverageFromBam) {
+        covStats.bamFile = Some(inputBam)
+        covStats.targets = Some(sortedBed)
+        add(covStats)
+      } else {
+        val bedCov = BedtoolsCoverage(this, sortedBed, inputBam, depth = true)
+        add(bedCov | covStats)
+      }
       addSummarizable(covStats, targetName + "_cov_stats")
     }
 
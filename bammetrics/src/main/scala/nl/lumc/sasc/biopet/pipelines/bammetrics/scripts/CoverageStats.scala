@@ -28,29 +28,80 @@ class CoverageStats(val parent: Configurable) extends PythonCommandLineFunction
   @Input(doc = "Input file", required = false)
   var input: File = _
 
+  /** When set, the coverage is computed from the bam file directly, instead of from the input */
+  @Input(doc = "Bam file", required = false)
+  var bamFile: Option[File] = None
+
+  /** Index of the bam file, defaults to the .bai next to it */
+  @Input(doc = "Bam index", required = false)
+  var bamIndex: Option[File] = None
+
+  @Input(doc = "Target regions (bed), used with the bam file", required = false)
+  var targets: Option[File] = None
+
+  var excludeFlags: Option[Int] = config("exclude_flags")
+  var minMapq: Option[Int] = config("min_mapq")
+
   @Output(doc = "output File")
   var output: File = _
 
   @Output(doc = "plot File (png)")
   var plot: File = _
 
+  /** Depth thresholds for the low coverage gaps, no gaps file is written when empty */
+  var gapThresholds: List[Int] = config("gap_thresholds", default = Nil)
+
+  @Output(doc = "Low coverage gaps (bed)", required = false)
+  var gaps: Option[File] = None
+
+  /** Write the mean depth per bin of binSize bases as bedGraph, e.g. to build a bigWig from */
+  var writeBedGraph: Boolean = config("bedgraph", default = false)
+  var binSize: Option[Int] = config("bin_size")
+
+  @Output(doc = "Binned mean depth (bedGraph)", required = false)
+  var bedGraph: Option[File] = None
+
   var title: Option[String] = None
   var subTitle: Option[String] = None
 
   override def defaultCoreMemory = 9.0
 
+  /** Targets are split over worker processes in bam mode, one per core */
+  override def defaultThreads = 1
+
+  override def beforeGraph(): Unit = {
+    super.beforeGraph()
+    if (bamIndex.isEmpty)
+      bamIndex = bamFile.map(bam => new File(bam.getPath.stripSuffix(".bam") + ".bai"))
+  }
+
   def cmdLine: String =
     getPythonCommand +
-      (if (inputAsStdin) " - " else required(input)) +
+      (bamFile match {
+        case Some(bam) =>
+          required("--bam", bam) +
+            required("--targets", targets) +
+            required("-t", threads) +
+            optional("--exclude-flags", excludeFlags) +
+            optional("--min-mapq", minMapq)
+        case _ => if (inputAsStdin) " - " else required(input)
+      }) +
+      optional("--gaps", gaps) +
+      (if (gaps.isDefined) repeat("--gap-threshold", gapThresholds) else "") +
+      optional("--bedgraph", bedGraph) +
+      (if (bedGraph.isDefined) optional("--bin-size", binSize) else "") +
       required("--plot", plot) +
       optional("--title", title) +
       optional("--subtitle", subTitle) +
       " > " + required(output)
 
-  def summaryFiles: Map[String, File] = Map("plot" -> plot)
+  def summaryFiles: Map[String, File] = Map("plot" -> plot) ++ gaps.map("gaps" -> _) ++
+    bedGraph.map("bedgraph" -> _)
 
   def summaryStats: Map[String, Any] = {
-    ConfigUtils.fileToConfigMap(output)
+    val metrics = pythonMetricsSummary
+    ConfigUtils.fileToConfigMap(output) ++
+      (if (metrics.nonEmpty) Map("runtime_metrics" -> metrics) else Map())
   }
 }
 
@@ -59,6 +110,13 @@ object CoverageStats {
     val coverageStats = new CoverageStats(root)
     coverageStats.output = new File(outputDir, name + ".stats")
     coverageStats.plot = new File(outputDir, name + ".stats.png")
+    if (coverageStats.gapThresholds.nonEmpty)
+      coverageStats.gaps = Some(new File(outputDir, name + ".gaps.bed"))
+    if (coverageStats.writeBedGraph)
+      coverageStats.bedGraph = Some(new File(outputDir, name + ".bedgraph"))
+    // runs inside a pipe, which has no job output file of its own to put the metrics next to
+    if (coverageStats.pythonMetrics)
+      coverageStats.pythonMetricsFile = Some(new File(outputDir, name + ".stats.metrics.json"))
     coverageStats
   }
 }
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+#
+# Biopet is built on top of GATK Queue for building bioinformatic
+# pipelines. It is mainly intended to support LUMC SHARK cluster which is running
+# SGE. But other types of HPC that are supported by GATK Queue (such as PBS)
+# should also be able to execute Biopet tools and pipelines.
+#
+# Copyright 2014 Sequencing Analysis Support Core - Leiden University Medical Center
+#
+# Contact us at: sasc@lumc.nl
+#
+# A dual licensing mode is applied. The source code within this project is freely available for non-commercial use under an AGPL
+# license; For commercial users or users who do not want to follow the AGPL
+# license, please contact us to obtain a separate license.
+#
+
+"""
+Benchmark the Python scripts bundled with Biopet on synthetic data.
+
+Inputs are generated once per scale in the work directory and reused by
+later runs. Each script runs the way PythonCommandLineFunction runs it: the
+script and the shared helper modules are copied into one directory, and the
+script is started in a fresh interpreter. Wall time, throughput and the
+peak RSS (VmHWM) the script reports through BIOPET_METRICS are recorded.
+
+Results are written as JSON. When a baseline is given, the throughput and
+peak memory of every benchmark are compared against it. The run exits with
+status 1 when one of them regressed by more than the tolerance, or when a
+script failed.
+
+Runs offline on a single Linux machine; benchmarks whose dependencies
+(numpy, matplotlib, pysam) are missing are skipped.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+import generators
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+HELPERS = "biopet-core/src/main/resources/nl/lumc/sasc/biopet/core/extensions"
+TARMAC = "tarmac/src/main/resources/nl/lumc/sasc/biopet/pipelines/tarmac/scripts"
+EXTENSIONS = "biopet-extensions/src/main/resources/nl/lumc/sasc/biopet/extensions"
+
+# multipliers of the per-benchmark base sizes
+SCALES = {"panel": 1, "exome": 25, "wgs": 500}
+DEFAULT_SCALES = ["panel", "exome"]
+DEFAULT_TOLERANCE = 0.2
+
+
+class Benchmark(object):
+    """
+    A script benchmark.
+
+    :param name: benchmark name
+    :param script: script path relative to the repository root
+    :param generator: generators function creating the input
+    :param base: number of records at the 'panel' scale
+    :param argv: function (input, workdir) -> script arguments
+    :param stdin: feed the input on stdin instead of by argument
+    :param requires: modules the script or generator needs
+    :param directory: the generator writes a directory instead of a file
+    """
+
+    def __init__(self, name, script, generator, base, argv, stdin=False,
+                 requires=(), directory=False):
+        self.name = name
+        self.script = script
+        self.generator = generator
+        self.base = base
+        self.argv = argv
+        self.stdin = stdin
+        self.requires = requires
+        self.directory = directory
+
+    def missing(self):
+        """Names of required modules that cannot be imported."""
+        missing = []
+        for module in self.requires:
+            try:
+                __import__(module)
+            except ImportError:
+                missing.append(module)
+        return missing
+
+
+def _z(input_path, name):
+    return os.path.join(input_path, name)
+
+
+BENCHMARKS = [
+    Benchmark("bedtools_cov_stats",
+              "bammetrics/src/main/resources/nl/lumc/sasc/biopet/pipelines/"
+              "bammetrics/scripts/bedtools_cov_stats.py",
+              generators.coverage_d, 200000,
+              lambda i, w: [i]),
+    Benchmark("bedtools_cov_stats.plot",
+              "bammetrics/src/main/resources/nl/lumc/sasc/biopet/pipelines/"
+              "bammetrics/scripts/bedtools_cov_stats.py",
+              generators.coverage_d, 200000,
+              lambda i, w: [i, "--plot", os.path.join(w, "coverage.png")],
+              requires=("numpy", "matplotlib")),
+    Benchmark("fix_mpileup", EXTENSIONS + "/varscan/fix_mpileup.py",
+              generators.mpileup, 100000, lambda i, w: [], stdin=True),
+    Benchmark("fix_iupac_mpileup", EXTENSIONS + "/samtools/fix_iupac_mpileup.py",
+              generators.mpileup, 100000, lambda i, w: [], stdin=True),
+    Benchmark("breakdancer2vcf", EXTENSIONS + "/breakdancer/breakdancer2vcf.py",
+              generators.breakdancer, 10000,
+              lambda i, w: ["-i", i, "-o", os.path.join(w, "out.vcf"),
+                            "-s", "sample"]),
+    Benchmark("select_sample_from_matrix", TARMAC + "/select_sample_from_matrix.py",
+              generators.xhmm_matrix, 10000,
+              lambda i, w: ["-I", i, "-s", "sample7"]),
+    Benchmark("bed_threshold", TARMAC + "/bed_threshold.py",
+              generators.stouffer_beds, 20000,
+              lambda i, w: ["-i", _z(i, "z0.bed"), "-t", "5"],
+              requires=("numpy",), directory=True),
+    Benchmark("find_all_common", TARMAC + "/find_all_common.py",
+              generators.stouffer_beds, 20000,
+              lambda i, w: ["--input", _z(i, "z0.bed"), "--db", _z(i, "z1.bed"),
+                            "--db", _z(i, "z2.bed")],
+              directory=True),
+    Benchmark("tarmac_plot", TARMAC + "/tarmac_plot.py",
+              generators.tarmac_plot_inputs, 4,
+              lambda i, w: ["-c", _z(i, "calls.bed.gz"),
+                            "-w", _z(i, "wisecondor.bed.gz"),
+                            "-x", _z(i, "xhmm.bed.gz"),
+                            "-s", _z(i, "stouff.bed.gz"),
+                            "-o", os.path.join(w, "plots")],
+              requires=("pysam", "matplotlib"), directory=True),
+    Benchmark("freec_CNVPlot", EXTENSIONS + "/freec/freec_CNVPlot.py",
+              generators.freec_ratio, 20000,
+              lambda i, w: ["-I", i, "-O", os.path.join(w, "freec")],
+              requires=("numpy", "matplotlib")),
+    Benchmark("tophat-recondition",
+              "mapping/src/main/resources/nl/lumc/sasc/biopet/pipelines/"
+              "mapping/scripts/tophat-recondition.py",
+              generators.tophat_output, 20000,
+              lambda i, w: [i, w],
+              requires=("pysam",), directory=True),
+]
+
+
+def prepare_scripts(workdir):
+    """Copy all scripts and helper modules into one directory, like Queue does."""
+    scripts = os.path.join(workdir, "scripts")
+    if os.path.isdir(scripts):
+        shutil.rmtree(scripts)
+    os.makedirs(scripts)
+    helper_dir = os.path.join(REPO, HELPERS)
+    for name in os.listdir(helper_dir):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(helper_dir, name), scripts)
+    for benchmark in BENCHMARKS:
+        shutil.copy(os.path.join(REPO, benchmark.script), scripts)
+    return scripts
+
+
+def generate(benchmark, scale, workdir, seed):
+    """Generate (or reuse) the input of a benchmark; returns (path, records)."""
+    n = benchmark.base * SCALES[scale]
+    key = "{0}.{1}.{2}".format(benchmark.generator.__name__, n, seed)
+    path = os.path.join(workdir, "data", key)
+    done = path + ".records"
+    if os.path.exists(done):
+        with open(done) as handle:
+            return path, int(handle.read())
+    if benchmark.directory:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+    elif not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    records = benchmark.generator(path, n, random.Random(seed))
+    with open(done, "w") as handle:
+        handle.write(str(records))
+    return path, records
+
+
+def run_once(python, script, argv, stdin_path, workdir):
+    """
+    Run a script; returns (exit code, seconds, peak rss in kB). The peak RSS
+    is the VmHWM the script reports through its BIOPET_METRICS sidecar (see
+    biopet_runtime.py), None when it wrote none. The ru_maxrss of wait4 is
+    not used: on Linux it includes the memory of this driver at fork time.
+    """
+    metrics = os.path.join(workdir, "metrics.json")
+    if os.path.exists(metrics):
+        os.remove(metrics)
+    env = dict(os.environ, BIOPET_METRICS=metrics)
+    stdin = open(stdin_path) if stdin_path else open(os.devnull)
+    with stdin, open(os.devnull, "w") as stdout, \
+            open(os.path.join(workdir, "stderr.log"), "a") as stderr:
+        start = time.time()
+        code = subprocess.call([python, script] + argv, stdin=stdin,
+                               stdout=stdout, stderr=stderr, cwd=workdir, env=env)
+        seconds = time.time() - start
+    rss = None
+    if os.path.exists(metrics):
+        with open(metrics) as handle:
+            peak = json.load(handle).get("peak_rss")
+        if peak is not None:
+            rss = peak // 1024
+    return (code if code >= 0 else 1), seconds, rss
+
+
+def run_benchmark(benchmark, scale, python, scripts, workdir, seed, repeat):
+    input_path, records = generate(benchmark, scale, workdir, seed)
+    run_dir = os.path.join(workdir, "run", benchmark.name)
+    script = os.path.join(scripts, os.path.basename(benchmark.script))
+    best = None
+    for _ in range(repeat):
+        if os.path.isdir(run_dir):
+            shutil.rmtree(run_dir)
+        os.makedirs(run_dir)
+        result = run_once(python, script, benchmark.argv(input_path, run_dir),
+                          input_path if benchmark.stdin else None, run_dir)
+        if best is None or result[1] < best[1]:
+            best = result
+    code, seconds, rss = best
+    return {
+        "exit_code": code,
+        "records": records,
+        "seconds": round(seconds, 4),
+        "records_per_second": round(records / seconds, 1) if seconds > 0 else None,
+        "peak_rss_kb": rss,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    List of human readable regressions of results against a baseline. A
+    benchmark that exited with an error is always a regression.
+    """
+    regressions = []
+    for name, scales in results["benchmarks"].items():
+        for scale, result in scales.items():
+            if result["exit_code"] != 0:
+                regressions.append("{0} [{1}]: exit code {2}".format(
+                    name, scale, result["exit_code"]))
+                continue
+            base = baseline.get("benchmarks", {}).get(name, {}).get(scale)
+            if base is None or "records_per_second" not in result:
+                continue
+            # a run too short to time has no rate, nothing to compare then
+            if base.get("records_per_second") and result["records_per_second"] is not None \
+                    and result["records_per_second"] < base["records_per_second"] * (1 - tolerance):
+                regressions.append("{0} [{1}]: throughput {2} < baseline {3} rec/s".format(
+                    name, scale, result["records_per_second"], base["records_per_second"]))
+            if base.get("peak_rss_kb") and result["peak_rss_kb"] and result["peak_rss_kb"] > \
+                    base["peak_rss_kb"] * (1 + tolerance):
+                regressions.append("{0} [{1}]: peak RSS {2} > baseline {3} kB".format(
+                    name, scale, result["peak_rss_kb"], base["peak_rss_kb"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__.strip())
+    parser.add_argument("-w", "--workdir", default="/tmp/biopet-python-benchmarks",
+                        help="Directory for generated data and runs (default: %(default)s)")
+    parser.add_argument("-s", "--scale", action="append", choices=sorted(SCALES),
+                        help="Scale(s) to run (default: {0})".format(
+                            " ".join(DEFAULT_SCALES)))
+    parser.add_argument("-b", "--benchmark", action="append",
+                        choices=[x.name for x in BENCHMARKS],
+                        help="Benchmark(s) to run (default: all)")
+    parser.add_argument("--python", default=sys.executable,
+                        help="Interpreter to run the scripts with (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per benchmark; the fastest run is kept")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("-o", "--output", default="-",
+                        help="Results JSON (default: stdout)")
+    parser.add_argument("--baseline", help="Baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed relative throughput drop / memory increase "
+                             "(default: %(default)s)")
+    args = parser.parse_args()
+
+    scales = args.scale or DEFAULT_SCALES
+    selected = [x for x in BENCHMARKS if not args.benchmark or x.name in args.benchmark]
+    workdir = os.path.abspath(args.workdir)
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    scripts = prepare_scripts(workdir)
+
+    results = {
+        "python": subprocess.check_output(
+            [args.python, "-c", "import platform; print(platform.python_version())"]
+        ).decode().strip(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count() if hasattr(os, "cpu_count") else None,
+        "seed": args.seed,
+        "benchmarks": {},
+    }
+    for benchmark in selected:
+        missing = benchmark.missing()
+        if missing:
+            print("Skipping {0}: missing {1}".format(benchmark.name, ", ".join(missing)),
+                  file=sys.stderr)
+            continue
+        for scale in scales:
+            result = run_benchmark(benchmark, scale, args.python, scripts, workdir,
+                                   args.seed, args.repeat)
+            results["benchmarks"].setdefault(benchmark.name, {})[scale] = result
+            print("{0} [{1}]: {2} records in {3}s, {4} rec/s, {5} kB peak RSS{6}".format(
+                benchmark.name, scale, result["records"], result["seconds"],
+                result["records_per_second"], result["peak_rss_kb"],
+                "" if result["exit_code"] == 0 else
+                " (exit code {0}, see {1})".format(result["exit_code"],
+                                                   os.path.join(workdir, "run")),
+            ), file=sys.stderr)
+
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+    # failed scripts fail the run, with or without a baseline
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression, file=sys.stderr)
+    sys.exit(1 if regressions else 0)
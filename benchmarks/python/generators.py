@@ -0,0 +1,247 @@
+#
+# Biopet is built on top of GATK Queue for building bioinformatic
+# pipelines. It is mainly intended to support LUMC SHARK cluster which is running
+# SGE. But other types of HPC that are supported by GATK Queue (such as PBS)
+# should also be able to execute Biopet tools and pipelines.
+#
+# Copyright 2014 Sequencing Analysis Support Core - Leiden University Medical Center
+#
+# Contact us at: sasc@lumc.nl
+#
+# A dual licensing mode is applied. The source code within this project is freely available for non-commercial use under an AGPL
+# license; For commercial users or users who do not want to follow the AGPL
+# license, please contact us to obtain a separate license.
+#
+
+"""
+Synthetic input generators for the Python script benchmarks.
+
+Every generator takes an output path (or directory), a number of records
+and a random.Random instance, writes realistic-looking data and returns
+the number of records it wrote. Output is deterministic for a given seed.
+"""
+
+from __future__ import print_function
+
+import os
+
+# GRCh37-like contig lengths, scaled down per generator where needed
+CONTIGS = [("1", 249250621), ("2", 243199373), ("3", 198022430),
+           ("4", 191154276), ("5", 180915260), ("X", 155270560)]
+BASES = "ACGT"
+IUPAC = "RYKMSWBDHV"
+
+
+def _contig_shares(n):
+    """Split n records over the contigs proportional to their length."""
+    total = float(sum(length for _, length in CONTIGS))
+    shares = [int(n * length / total) for _, length in CONTIGS]
+    shares[0] += n - sum(shares)
+    return [(name, length, share) for (name, length), share in zip(CONTIGS, shares)]
+
+
+def coverage_d(path, n, rng):
+    """`bedtools coverage -d` output: target bed columns, position, depth."""
+    written = 0
+    with open(path, "w") as handle:
+        for chrom, length, share in _contig_shares(n):
+            pos = 10000
+            left = share
+            while left > 0:
+                size = min(left, rng.randint(120, 300))
+                start = pos
+                end = start + size
+                mean = rng.choice((5, 30, 30, 60, 120))
+                for i in range(1, size + 1):
+                    depth = max(0, int(rng.gauss(mean, mean / 3.0)))
+                    handle.write("{0}\t{1}\t{2}\ttarget\t{3}\t{4}\n".format(
+                        chrom, start, end, i, depth))
+                written += size
+                left -= size
+                pos = end + rng.randint(500, 20000)
+    return written
+
+
+def mpileup(path, n, rng):
+    """samtools mpileup text with IUPAC reference bases and RNA skips."""
+    with open(path, "w") as handle:
+        for chrom, length, share in _contig_shares(n):
+            pos = rng.randint(1, 100000)
+            for _ in range(share):
+                pos += rng.randint(1, 20)
+                ref = rng.choice(IUPAC) if rng.random() < 0.01 else rng.choice(BASES)
+                depth = rng.randint(0, 40)
+                if depth == 0:
+                    handle.write("{0}\t{1}\t{2}\t0\t*\t*\n".format(chrom, pos, ref))
+                    continue
+                bases = "".join(rng.choice(".,.,.,<>ACGT") for _ in range(depth))
+                quals = "".join(chr(rng.randint(53, 73)) for _ in range(depth))
+                handle.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(
+                    chrom, pos, ref, depth, bases, quals))
+    return n
+
+
+def breakdancer(path, n, rng):
+    """breakdancer-max TSV output including its comment header."""
+    types = ("DEL", "DEL", "INS", "INV", "ITX", "CTX")
+    with open(path, "w") as handle:
+        handle.write("#Software: breakdancer-max\n")
+        handle.write("#Command: breakdancer-max sample.cfg\n")
+        handle.write("#Library Statistics:\n")
+        handle.write("#/data/sample.bam\tmean:350.2\tstd:42.1\tuppercutoff:501.4"
+                     "\tlowercutoff:118.3\treadlen:100\tlibrary:lib1\treflen:3000000000"
+                     "\tseqcov:30\tphycov:52\t1:13\t2:2\t3:10\t4:1\t8:40\n")
+        handle.write("#Chr1\tPos1\tOrientation1\tChr2\tPos2\tOrientation2\tType"
+                     "\tSize\tScore\tnum_Reads\tnum_Reads_lib\tsample.bam\n")
+        for chrom, length, share in _contig_shares(n):
+            for _ in range(share):
+                sv = rng.choice(types)
+                pos1 = rng.randint(1, length - 100000)
+                if sv == "CTX":
+                    chrom2 = rng.choice(CONTIGS)[0]
+                    pos2 = rng.randint(1, 1000000)
+                    size = 0
+                else:
+                    chrom2 = chrom
+                    size = rng.randint(50, 50000)
+                    pos2 = pos1 + size
+                reads = rng.randint(2, 80)
+                score = rng.randint(1, 99)
+                handle.write("{0}\t{1}\t{2}+{3}-\t{4}\t{5}\t{2}+{3}-\t{6}\t{7}\t{8}"
+                             "\t{9}\t/data/sample.bam|{9}\tNA\n".format(
+                                 chrom, pos1, reads // 2, reads - reads // 2, chrom2,
+                                 pos2, sv, size, score, reads))
+    return n
+
+
+def _regions(n, rng):
+    """n sorted exome-like target regions as (chrom, start, end)."""
+    regions = []
+    for chrom, length, share in _contig_shares(n):
+        pos = 10000
+        for _ in range(share):
+            pos += rng.randint(200, 20000)
+            size = rng.randint(100, 400)
+            regions.append((chrom, pos, pos + size))
+            pos += size
+    return regions
+
+
+def xhmm_matrix(path, n, rng, samples=20):
+    """XHMM z-score matrix with n targets; samples are named sample0.."""
+    regions = _regions(n, rng)
+    with open(path, "w") as handle:
+        handle.write("Matrix\t" + "\t".join(
+            "{0}:{1}-{2}".format(c, s, e) for c, s, e in regions) + "\n")
+        for i in range(samples):
+            handle.write("sample{0}\t".format(i) + "\t".join(
+                "{0:.3f}".format(rng.gauss(0, 2)) for _ in regions) + "\n")
+    return n
+
+
+def stouffer_beds(directory, n, rng, files=3):
+    """
+    Sorted 4-column z-score BEDs (as produced by the Stouffer steps) over a
+    shared region grid, each missing ~5% of the regions.
+    """
+    regions = _regions(n, rng)
+    for i in range(files):
+        with open(os.path.join(directory, "z{0}.bed".format(i)), "w") as handle:
+            # a run of strongly deviating z-scores every ~200 regions
+            in_event = False
+            for chrom, start, end in regions:
+                if rng.random() < 0.05:
+                    continue
+                if rng.random() < 0.005:
+                    in_event = not in_event
+                mean = 8 if in_event else 0
+                handle.write("{0}\t{1}\t{2}\t{3:.3f}\n".format(
+                    chrom, start, end, rng.gauss(mean, 2)))
+    return n
+
+
+def tarmac_plot_inputs(directory, n, rng):
+    """
+    bgzipped, tabix indexed call, Wisecondor, XHMM and Stouffer files for
+    tarmac_plot.py; n is the number of calls. Needs pysam.
+    """
+    import pysam
+    regions = _regions(n * 50, rng)
+    tracks = {}
+    for name in ("stouff", "wisecondor", "xhmm"):
+        tracks[name] = os.path.join(directory, name + ".bed")
+        with open(tracks[name], "w") as handle:
+            for chrom, start, end in regions:
+                handle.write("{0}\t{1}\t{2}\t{3:.3f}\n".format(
+                    chrom, start, end, rng.gauss(0, 3)))
+    calls = os.path.join(directory, "calls.bed")
+    with open(calls, "w") as handle:
+        for i in range(0, len(regions) - 10, 50):
+            chrom, start, _ = regions[i]
+            end = regions[i + 10][2]
+            if regions[i + 10][0] == chrom:
+                handle.write("{0}\t{1}\t{2}\t{3:.3f}\n".format(
+                    chrom, start, end, rng.gauss(8, 2)))
+    for path in list(tracks.values()) + [calls]:
+        pysam.tabix_index(path, preset="bed", force=True)
+    return n
+
+
+def freec_ratio(path, n, rng):
+    """Control-FREEC *_ratio.txt with copy-number segments."""
+    with open(path, "w") as handle:
+        handle.write("Chromosome\tStart\tRatio\tMedianRatio\tCopyNumber\n")
+        for chrom, length, share in _contig_shares(n):
+            window = max(1, length // max(1, share))
+            cn = 2
+            for i in range(share):
+                if rng.random() < 0.001:
+                    cn = rng.choice((1, 2, 2, 2, 3, 4))
+                ratio = max(0.0, rng.gauss(cn / 2.0, 0.1))
+                handle.write("{0}\t{1}\t{2:.4f}\t{3:.4f}\t{4}\n".format(
+                    chrom, i * window + 1, ratio, cn / 2.0, cn))
+    return n
+
+
+def tophat_output(directory, n, rng):
+    """
+    A TopHat output directory with name-sorted accepted_hits.bam and
+    unmapped.bam for n read pairs, half of which have one mate mapped.
+    Needs pysam.
+    """
+    import pysam
+    header = {"HD": {"VN": "1.0", "SO": "queryname"},
+              "SQ": [{"SN": name, "LN": length} for name, length in CONTIGS],
+              "PG": [{"ID": "TopHat", "VN": "2.1.1"}]}
+    seq = "".join(rng.choice(BASES) for _ in range(100))
+    qual = pysam.qualitystring_to_array("I" * 100)
+
+    def read(name, flag, tid=-1, pos=-1):
+        segment = pysam.AlignedSegment()
+        segment.query_name = name
+        segment.flag = flag
+        segment.reference_id = tid
+        segment.reference_start = pos
+        segment.mapping_quality = 50 if tid >= 0 else 255
+        if tid >= 0:
+            segment.cigarstring = "100M"
+        segment.query_sequence = seq
+        segment.query_qualities = qual
+        return segment
+
+    mapped_path = os.path.join(directory, "accepted_hits.bam")
+    unmapped_path = os.path.join(directory, "unmapped.bam")
+    with pysam.AlignmentFile(mapped_path, "wb", header=header) as mapped, \
+            pysam.AlignmentFile(unmapped_path, "wb", header=header) as unmapped:
+        for i in range(n):
+            name = "read{0:010d}".format(i)
+            if rng.random() < 0.5:
+                tid = rng.randrange(len(CONTIGS))
+                pos = rng.randint(1, 1000000)
+                # paired, mate unmapped, first in pair
+                mapped.write(read(name, 0x1 | 0x8 | 0x40, tid, pos))
+                unmapped.write(read(name + "/2", 0x1 | 0x4 | 0x80))
+            else:
+                unmapped.write(read(name + "/1", 0x1 | 0x4 | 0x8 | 0x40))
+                unmapped.write(read(name + "/2", 0x1 | 0x4 | 0x8 | 0x80))
+    return n
@@ -0,0 +1,97 @@
+#
+# Biopet is built on top of GATK Queue for building bioinformatic
+# pipelines. It is mainly intended to support LUMC SHARK cluster which is running
+# SGE. But other types of HPC that are supported by GATK Queue (such as PBS)
+# should also be able to execute Biopet tools and pipelines.
+#
+# Copyright 2014 Sequencing Analysis Support Core - Leiden University Medical Center
+#
+# Contact us at: sasc@lumc.nl
+#
+# A dual licensing mode is applied. The source code within this project is freely available for non-commercial use under an AGPL
+# license; For commercial users or users who do not want to follow the AGPL
+# license, please contact us to obtain a separate license.
+#
+
+"""Smoke tests of the benchmark harness."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import benchmark
+
+SCRIPT = """
+import sys
+import biopet_runtime
+biopet_runtime.init(__file__)
+data = bytearray({size})
+sys.exit({code})
+"""
+
+
+class RunOnceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(benchmark.REPO, benchmark.HELPERS, "biopet_runtime.py"),
+                    self.workdir)
+        # memory held by the driver must not show up in the peak of the script
+        self.ballast = bytearray(200 * 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def script(self, size, code):
+        path = os.path.join(self.workdir, "script.py")
+        with open(path, "w") as handle:
+            handle.write(SCRIPT.format(size=size, code=code))
+        return path
+
+    def test_peak_rss(self):
+        code, seconds, rss = benchmark.run_once(
+            sys.executable, self.script(64 * 1024 * 1024, 0), [], None, self.workdir)
+        self.assertEqual(code, 0)
+        self.assertGreater(seconds, 0)
+        if sys.platform.startswith("linux"):
+            self.assertGreater(rss, 64 * 1024)
+            self.assertLess(rss, 200 * 1024)
+
+    def test_exit_code(self):
+        code, _, _ = benchmark.run_once(
+            sys.executable, self.script(0, 3), [], None, self.workdir)
+        self.assertEqual(code, 3)
+
+
+class CompareTest(unittest.TestCase):
+
+    @staticmethod
+    def results(exit_code=0, rate=100.0, rss=1000):
+        return {"benchmarks": {"x": {"panel": {
+            "exit_code": exit_code, "records_per_second": rate, "peak_rss_kb": rss}}}}
+
+    def test_no_regression(self):
+        self.assertEqual(benchmark.compare(self.results(), self.results(), 0.2), [])
+
+    def test_throughput_and_memory(self):
+        regressions = benchmark.compare(self.results(rate=50.0, rss=2000),
+                                        self.results(), 0.2)
+        self.assertEqual(len(regressions), 2)
+
+    def test_failure_without_baseline(self):
+        regressions = benchmark.compare(self.results(exit_code=1), {}, 0.2)
+        self.assertEqual(regressions, ["x [panel]: exit code 1"])
+
+    def test_missing_rss(self):
+        self.assertEqual(benchmark.compare(self.results(rss=None), self.results(), 0.2), [])
+
+    def test_missing_rate(self):
+        self.assertEqual(benchmark.compare(self.results(rate=None), self.results(), 0.2), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+#
+# Biopet is built on top of GATK Queue for building bioinformatic
+# pipelines. It is mainly intended to support LUMC SHARK cluster which is running
+# SGE. But other types of HPC that are supported by GATK Queue (such as PBS)
+# should also be able to execute Biopet tools and pipelines.
+#
+# Copyright 2014 Sequencing Analysis Support Core - Leiden University Medical Center
+#
+# Contact us at: sasc@lumc.nl
+#
+# A dual licensing mode is applied. The source code within this project is freely available for non-commercial use under an AGPL
+# license; For commercial users or users who do not want to follow the AGPL
+# license, please contact us to obtain a separate license.
+#
+
+"""
+Single-archive bundle of the Python scripts bundled with Biopet.
+
+Instead of extracting every script (and the shared helper modules) from
+the jar and compiling it on every run, PythonCommandLineFunction can build
+one zip archive per run with biopet_bundle_build.py, holding the sources
+together with their bytecode compiled by the interpreter that runs the
+jobs, and run the scripts from it by name:
+
+    python biopet-python.pyz <script> [args...]
+    python biopet-python.pyz --list
+
+<script> is the file name of a script without '.py'; it runs as __main__,
+exactly like `python <script>.py args`. The bytecode is used when the
+archive is run by the interpreter that built it; any other interpreter
+falls back to the sources.
+
+This module is imported by the archive on every start, so it only imports
+what running a script needs.
+
+Works with both Python 2.7 and Python 3.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import types
+import zipimport
+
+INFO_NAME = "bundle.json"
+MAIN = "import biopet_bundle\nbiopet_bundle.main()\n"
+
+
+def _importer():
+    return zipimport.zipimporter(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bundle_info():
+    """Contents of the index of the archive this module is loaded from."""
+    importer = _importer()
+    return json.loads(importer.get_data(
+        os.path.join(importer.archive, INFO_NAME)).decode("utf-8"))
+
+
+def run_script(name, argv):
+    """
+    Run a script from the archive as __main__ with the given arguments.
+    The script replaces the __main__ module, so functions it defines can be
+    pickled, e.g. by multiprocessing.
+    """
+    importer = _importer()
+    code = importer.get_code(name)
+    module = types.ModuleType("__main__")
+    module.__file__ = importer.get_filename(name)
+    module.__loader__ = importer
+    sys.modules["__main__"] = module
+    # the script sees the same argv as when it is started directly
+    sys.argv = [name + ".py"] + list(argv)
+    exec(code, module.__dict__)
+
+
+def main():
+    """Entry point of the archive: run a script by name."""
+    info = bundle_info()
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help", "--list"):
+        print("Biopet python scripts {0} (built with python {1})\n\nUsage: "
+              "{2} <script> [args...]\n\nScripts:".format(
+                  info["version"], info["python"], os.path.basename(sys.argv[0])))
+        for name in info["scripts"]:
+            print("  " + name)
+        sys.exit(0 if len(sys.argv) >= 2 else 1)
+    name = sys.argv[1]
+    if name not in info["scripts"]:
+        print("Unknown script: {0}, see --list".format(name), file=sys.stderr)
+        sys.exit(2)
+    run_script(name, sys.argv[2:])
@@ -0,0 +1,112 @@
+#
+# Biopet is built on top of GATK Queue for building bioinformatic
+# pipelines. It is mainly intended to support LUMC SHARK cluster which is running
+# SGE. But other types of HPC that are supported by GATK Queue (such as PBS)
+# should also be able to execute Biopet tools and pipelines.
+#
+# Copyright 2014 Sequencing Analysis Support Core - Leiden University Medical Center
+#
+# Contact us at: sasc@lumc.nl
+#
+# A dual licensing mode is applied. The source code within this project is freely available for non-commercial use under an AGPL
+# license; For commercial users or users who do not want to follow the AGPL
+# license, please contact us to obtain a separate license.
+#
+
+"""
+Builds the single-archive bundle of the Python scripts bundled with Biopet,
+see biopet_bundle.py for how it is run:
+
+    python biopet_bundle_build.py -o biopet-python.pyz [--version V] \
+        [-m helper.py ...] script.py ...
+
+Kept apart from biopet_bundle.py, which the archive imports on every
+start, so the scripts do not pay for the modules only the build needs.
+
+Works with both Python 2.7 and Python 3.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+import biopet_bundle
+
+
+def _zip_info(name, mtime):
+    info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def _source(module):
+    path = os.path.abspath(module.__file__)
+    if path.endswith((".pyc", ".pyo")):
+        path = path[:-1]
+    return path
+
+
+def build(output, scripts, modules=(), version="unknown"):
+    """
+    Write the archive: sources, bytecode compiled by this interpreter, an
+    index of the scripts and a __main__ dispatching to them. Helper modules
+    are included but not listed as scripts. The archive is written to a
+    temporary file first, so concurrent builds are safe.
+    """
+    runtime = _source(biopet_bundle)
+    files = list(scripts) + list(modules)
+    if not any(os.path.abspath(x) == runtime for x in files):
+        files.append(runtime)
+    info = {
+        "version": version,
+        "python": sys.version.split()[0],
+        "scripts": sorted(os.path.splitext(os.path.basename(x))[0] for x in scripts),
+    }
+    compiled = tempfile.mkdtemp(prefix="biopet_bundle")
+    directory = os.path.dirname(os.path.abspath(output))
+    handle, tmp = tempfile.mkstemp(dir=directory, suffix=".pyz.tmp")
+    os.close(handle)
+    try:
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(_zip_info("__main__.py", time.time()), biopet_bundle.MAIN)
+            archive.writestr(_zip_info(biopet_bundle.INFO_NAME, time.time()),
+                             json.dumps(info, indent=2, sort_keys=True))
+            for source in files:
+                name = os.path.basename(source)
+                mtime = os.stat(source).st_mtime
+                with open(source, "rb") as src:
+                    archive.writestr(_zip_info(name, mtime), src.read())
+                # zipimport only looks for bytecode next to the source
+                pyc = os.path.join(compiled, name + "c")
+                py_compile.compile(source, cfile=pyc, doraise=True)
+                with open(pyc, "rb") as src:
+                    archive.writestr(_zip_info(name + "c", mtime), src.read())
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, output)
+    finally:
+        shutil.rmtree(compiled)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return info
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the bundle archive")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Archive to write")
+    parser.add_argument("--version", default="unknown",
+                        help="Biopet version recorded in the archive")
+    parser.add_argument("-m", "--module", action="append", default=[],
+                        help="Helper module to include, not runnable")
+    parser.add_argument("scripts", nargs="+", help="Scripts to include")
+    args = parser.parse_args()
+    build(args.output, args.scripts, args.module, args.version)
@@ -0,0 +1,268 @@
+#
+# Biopet is built on top of GATK Queue for building bioinformatic
+# pipelines. It is mainly intended to support LUMC SHARK cluster which is running
+# SGE. But other types of HPC that are supported by GATK Queue (such as PBS)
+# should also be able to execute Biopet tools and pipelines.
+#
+# Copyright 2014 Sequencing Analysis Support Core - Leiden University Medical Center
+#
+# Contact us at: sasc@lumc.nl
+#
+# A dual licensing mode is applied. The source code within this project is freely available for non-commercial use under an AGPL
+# license; For commercial users or users who do not want to follow the AGPL
+# license, please contact us to obtain a separate license.
+#
+
+"""
+Binary region-grid format for per-region values, as used by the Tarmac
+scripts.
+
+All files of a run describe the same set of regions (the targets of the
+XHMM matrix), so the regions are written once, to a region table, and each
+sample or stage only stores a values file: one float32 per region plus a
+bitmap of the regions that are present. Regions are matched by their index
+in the table, so combining files is array arithmetic instead of text
+parsing.
+
+Both files start with an 8 byte magic, a little-endian uint32 header
+length and a JSON header, followed by the little-endian arrays:
+
+    region table  (BPGRIDR1): contig ids (int32), starts (int64), ends (int64)
+    values file   (BPGRIDV1): values (float32), presence bitmap (packed bits)
+
+The header of a values file holds the digest of the region table it
+belongs to, so files of different grids are never combined by accident.
+
+Needs numpy. Works with both Python 2.7 and Python 3.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+import biopet_io
+
+REGIONS_MAGIC = b"BPGRIDR1"
+VALUES_MAGIC = b"BPGRIDV1"
+HEADER_SIZE = struct.Struct("<I")
+
+CONTIG_DTYPE = np.dtype("<i4")
+POSITION_DTYPE = np.dtype("<i8")
+VALUE_DTYPE = np.dtype("<f4")
+
+
+def _read_all(path):
+    with biopet_io.open_input(path, "rb") as handle:
+        return handle.read()
+
+
+def _unpack(data, magic, path):
+    if data[:len(magic)] != magic:
+        raise ValueError("{0} is not a {1} file".format(path, magic.decode("ascii")))
+    offset = len(magic)
+    (size,) = HEADER_SIZE.unpack_from(data, offset)
+    offset += HEADER_SIZE.size
+    header = json.loads(data[offset:offset + size].decode("utf-8"))
+    return header, offset + size
+
+
+def _array(data, offset, dtype, count):
+    array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+    return array, offset + count * dtype.itemsize
+
+
+def _write(path, magic, header, arrays):
+    """Write a grid file; regular files are written atomically."""
+    encoded = json.dumps(header).encode("utf-8")
+    target = path if path == "-" else "{0}.{1}.tmp".format(path, os.getpid())
+    with biopet_io.open_output(target, "wb", bgzf=False) as handle:
+        handle.write(magic + HEADER_SIZE.pack(len(encoded)) + encoded)
+        for array in arrays:
+            handle.write(array.tobytes())
+    if target != path:
+        os.rename(target, path)
+
+
+def file_type(path):
+    """
+    Return 'regions' or 'values' for region-grid files and None for anything
+    else (e.g. a BED file).
+    """
+    if not biopet_io.is_grid_file(path):
+        return None
+    with open(path, "rb") as handle:
+        magic = handle.read(len(REGIONS_MAGIC))
+    return {REGIONS_MAGIC: "regions", VALUES_MAGIC: "values"}.get(magic)
+
+
+class RegionGrid(object):
+    """
+    The region table: contig names and, per region, a contig id, start and
+    end. Regions keep the order they were given in.
+    """
+
+    def __init__(self, contigs, contig_ids, starts, ends):
+        self.contigs = list(contigs)
+        self.contig_ids = np.asarray(contig_ids, dtype=CONTIG_DTYPE)
+        self.starts = np.asarray(starts, dtype=POSITION_DTYPE)
+        self.ends = np.asarray(ends, dtype=POSITION_DTYPE)
+        self._digest = None
+        self._index = None
+
+    @classmethod
+    def from_regions(cls, regions):
+        """Create a grid from (chrom, start, end) tuples."""
+        contigs, ids = [], {}
+        contig_ids, starts, ends = [], [], []
+        for chrom, start, end in regions:
+            if chrom not in ids:
+                ids[chrom] = len(contigs)
+                contigs.append(chrom)
+            contig_ids.append(ids[chrom])
+            starts.append(int(start))
+            ends.append(int(end))
+        return cls(contigs, contig_ids, starts, ends)
+
+    @classmethod
+    def read(cls, path):
+        data = _read_all(path)
+        header, offset = _unpack(data, REGIONS_MAGIC, path)
+        n = header["regions"]
+        contig_ids, offset = _array(data, offset, CONTIG_DTYPE, n)
+        starts, offset = _array(data, offset, POSITION_DTYPE, n)
+        ends, offset = _array(data, offset, POSITION_DTYPE, n)
+        grid = cls(header["contigs"], contig_ids, starts, ends)
+        if grid.digest != header["digest"]:
+            raise ValueError("{0} is corrupt: digest mismatch".format(path))
+        return grid
+
+    def write(self, path):
+        _write(path, REGIONS_MAGIC,
+               {"regions": len(self), "contigs": self.contigs, "digest": self.digest},
+               [self.contig_ids, self.starts, self.ends])
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def digest(self):
+        """sha1 over the contig names and the region arrays."""
+        if self._digest is None:
+            sha1 = hashlib.sha1(json.dumps(self.contigs).encode("utf-8"))
+            for array in (self.contig_ids, self.starts, self.ends):
+                sha1.update(array.tobytes())
+            self._digest = sha1.hexdigest()
+        return self._digest
+
+    def bed_regions(self, indices=None):
+        """Yield 'chrom\\tstart\\tend' strings of all, or the given, regions."""
+        if indices is None:
+            indices = range(len(self))
+        contigs = self.contigs
+        contig_ids, starts, ends = (self.contig_ids.tolist(), self.starts.tolist(),
+                                    self.ends.tolist())
+        for i in indices:
+            yield "{0}\t{1}\t{2}".format(contigs[contig_ids[i]], starts[i], ends[i])
+
+    def index(self, region):
+        """Index of a 'chrom\tstart\tend' region; KeyError when not on the grid."""
+        if self._index is None:
+            self._index = dict((r, i) for i, r in enumerate(self.bed_regions()))
+        return self._index[region]
+
+
+def load_or_store_grid(grid, path):
+    """
+    Use the region table at path when it exists, after checking that it
+    describes the same regions as grid, or write grid to it otherwise.
+    Parallel jobs may all write the (identical) table; the write is atomic.
+    """
+    if os.path.exists(path):
+        stored = RegionGrid.read(path)
+        if stored.digest != grid.digest:
+            raise ValueError("Region table {0} does not match the regions of "
+                             "this input".format(path))
+        return stored
+    grid.write(path)
+    return grid
+
+
+class GridValues(object):
+    """One float32 value and a presence flag per region of a grid."""
+
+    def __init__(self, grid_digest, values, present, name=""):
+        self.grid_digest = grid_digest
+        self.values = np.asarray(values, dtype=VALUE_DTYPE)
+        self.present = np.asarray(present, dtype=bool)
+        self.name = name
+
+    @classmethod
+    def read(cls, path):
+        data = _read_all(path)
+        header, offset = _unpack(data, VALUES_MAGIC, path)
+        n = header["regions"]
+        values, offset = _array(data, offset, VALUE_DTYPE, n)
+        bitmap, offset = _array(data, offset, np.dtype("u1"), (n + 7) // 8)
+        present = np.unpackbits(bitmap)[:n].astype(bool)
+        return cls(header["grid"], values, present, header.get("name", ""))
+
+    @classmethod
+    def from_bed(cls, grid, handle, name=""):
+        """Read a 4-column BED file whose regions are all on the grid."""
+        values = np.zeros(len(grid), dtype=VALUE_DTYPE)
+        present = np.zeros(len(grid), dtype=bool)
+        for line in handle:
+            fields = line.rstrip("\n").split("\t")
+            try:
+                i = grid.index("\t".join(fields[:3]))
+            except KeyError:
+                raise ValueError("Region {0} of {1} is not in the region "
+                                 "table".format(" ".join(fields[:3]), name))
+            values[i] = float(fields[3])
+            present[i] = True
+        return cls(grid.digest, values, present, name)
+
+    def write(self, path):
+        _write(path, VALUES_MAGIC,
+               {"regions": len(self.values), "grid": self.grid_digest,
+                "name": self.name},
+               [self.values, np.packbits(self.present)])
+
+    def check_grid(self, grid, path=""):
+        if self.grid_digest != grid.digest:
+            raise ValueError("{0} belongs to a different region table".format(
+                path or self.name))
+
+    def bed_lines(self, grid):
+        """Yield 4-column BED lines (without newline) of the present regions."""
+        indices = np.flatnonzero(self.present)
+        values = self.values[indices].tolist()
+        for region, value in zip(grid.bed_regions(indices), values):
+            yield "{0}\t{1}".format(region, format_value(value))
+
+
+def load_values(path, grid=None):
+    """
+    Read a values file, or a 4-column BED file when a grid is given to map
+    its regions on. Values files are checked against the grid, if given.
+    """
+    if file_type(path) == "values":
+        values = GridValues.read(path)
+        if grid is not None:
+            values.check_grid(grid, path)
+        return values
+    if grid is None:
+        raise ValueError("{0} is not a region-grid values file; a region table "
+                         "is needed to read it".format(path))
+    with biopet_io.open_input(path) as handle:
+        return GridValues.from_bed(grid, handle, name=path)
+
+
+def format_value(value):
+    """Shortest text form of a float32 value, e.g. 1.1 instead of 1.10000002."""
+    return str(np.float32(value))
@@ -0,0 +1,291 @@
+#
+# Biopet is built on top of GATK Queue for building bioinformatic
+# pipelines. It is mainly intended to support LUMC SHARK cluster which is running
+# SGE. But other types of HPC that are supported by GATK Queue (such as PBS)
+# should also be able to execute Biopet tools and pipelines.
+#
+# Copyright 2014 Sequencing Analysis Support Core - Leiden University Medical Center
+#
+# Contact us at: sasc@lumc.nl
+#
+# A dual licensing mode is applied. The source code within this project is freely available for non-commercial use under an AGPL
+# license; For commercial users or users who do not want to follow the AGPL
+# license, please contact us to obtain a separate license.
+#
+
+"""
+Shared I/O helpers for the Python scripts bundled with Biopet.
+
+PythonCommandLineFunction extracts this module next to every script, so
+scripts can simply `import biopet_io`.
+
+Input opened with `open_input` may be plain text, gzip or BGZF; the format
+is detected from the magic bytes, not from the file name. Large compressed
+inputs are decompressed in a background thread. `open_output` writes plain
+text, or BGZF when asked for or when the file name ends in .gz / .bgz.
+
+Works with both Python 2.7 and Python 3.
+"""
+
+from __future__ import print_function
+
+import gzip
+import io
+import os
+import struct
+import sys
+import threading
+import zlib
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+PY3 = sys.version_info[0] >= 3
+
+GZIP_MAGIC = b"\x1f\x8b"
+# compressed inputs of at least this size are decompressed in a separate thread
+THREAD_THRESHOLD = 16 * 1024 * 1024
+# size of the chunks handed over by the decompression thread
+CHUNK_SIZE = 1024 * 1024
+# number of chunks the decompression thread may run ahead
+QUEUE_DEPTH = 8
+BUFFER_SIZE = 1024 * 1024
+
+# maximum number of uncompressed bytes in a single BGZF block
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+            b"\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def is_grid_file(path):
+    """
+    True if path is a region-grid file (see biopet_grid); checked here so
+    scripts can detect them without importing numpy.
+    """
+    if path == "-" or not os.path.isfile(path):
+        return False
+    with open(path, "rb") as handle:
+        return handle.read(6) == b"BPGRID"
+
+
+def is_gzip(header):
+    """True if the first bytes of a stream are a gzip (or BGZF) header."""
+    return header[:2] == GZIP_MAGIC
+
+
+def is_bgzf(header):
+    """True if the first bytes of a stream are a BGZF block header."""
+    # FEXTRA flag set and a 'BC' extra subfield
+    return (is_gzip(header) and len(header) >= 14 and
+            ord(header[3:4]) & 4 != 0 and header[12:14] == b"BC")
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Read a (decompressing) binary stream in a background thread.
+
+    zlib releases the GIL while inflating, so decompression runs alongside
+    the parsing done by the calling script.
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE, depth=QUEUE_DEPTH):
+        io.RawIOBase.__init__(self)
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=depth)
+        self._stopped = False
+        self._buffer = b""
+        self._offset = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stopped:
+                chunk = self._stream.read(self._chunk_size)
+                self._queue.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self._queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._offset >= len(self._buffer):
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._buffer, self._offset = item, 0
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stopped = True
+            # unblock the reader thread if it waits on a full queue
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._stream.close()
+        io.RawIOBase.close(self)
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    Binary writer producing BGZF: a series of independent gzip members of
+    at most 64 KB each, terminated by the standard empty EOF block, so the
+    output can be indexed by tabix and read by samtools / htslib.
+    """
+
+    def __init__(self, stream, level=6, close_stream=True):
+        io.RawIOBase.__init__(self)
+        self._stream = stream
+        self._level = level
+        self._close_stream = close_stream
+        self._pending = []
+        self._pending_size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        data = b.tobytes() if isinstance(b, memoryview) else bytes(b)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= BGZF_BLOCK_SIZE:
+            pending = b"".join(self._pending)
+            whole = len(pending) - len(pending) % BGZF_BLOCK_SIZE
+            for start in range(0, whole, BGZF_BLOCK_SIZE):
+                self._write_block(pending[start:start + BGZF_BLOCK_SIZE])
+            rest = pending[whole:]
+            self._pending = [rest] if rest else []
+            self._pending_size = len(rest)
+        return len(data)
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        # 18 header bytes and 8 trailer bytes
+        block_size = len(compressed) + 26
+        header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff,
+                             6, ord("B"), ord("C"), 2, block_size - 1)
+        trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                              len(data) & 0xffffffff)
+        self._stream.write(header + compressed + trailer)
+
+    def close(self):
+        if not self.closed:
+            if self._pending_size:
+                self._write_block(b"".join(self._pending))
+                self._pending, self._pending_size = [], 0
+            self._stream.write(BGZF_EOF)
+            self._stream.flush()
+            if self._close_stream:
+                self._stream.close()
+        io.RawIOBase.close(self)
+
+
+class _Closing(io.RawIOBase):
+    """Raw reader that closes the underlying file along with the decompressor."""
+
+    def __init__(self, stream, underlying):
+        io.RawIOBase.__init__(self)
+        self._stream = stream
+        self._underlying = underlying
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def readinto(self, b):
+        data = self._stream.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+            self._underlying.close()
+        io.RawIOBase.close(self)
+
+
+def _text(binary, mode):
+    # python 2 scripts work on byte strings; only wrap on python 3
+    if "b" in mode or not PY3:
+        return binary
+    return io.TextIOWrapper(binary)
+
+
+def open_input(path, mode="rt", threaded=None):
+    """
+    Open a plain, gzip or BGZF file for reading; '-' is stdin.
+
+    :param path: file name or '-'
+    :param mode: 'rt' (default) or 'rb'
+    :param threaded: decompress in a background thread. When None, a thread
+        is used for compressed stdin and compressed files of at least
+        THREAD_THRESHOLD bytes.
+    :return: file-like object
+    """
+    if path == "-":
+        raw = io.open(sys.stdin.fileno(), "rb", closefd=False)
+        size = None
+    else:
+        raw = io.open(path, "rb")
+        size = os.fstat(raw.fileno()).st_size
+    buffered = io.BufferedReader(raw, buffer_size=BUFFER_SIZE)
+    if not is_gzip(buffered.peek(2)):
+        return _text(buffered, mode)
+
+    # GzipFile reads concatenated members, so it handles BGZF as well
+    stream = gzip.GzipFile(fileobj=buffered, mode="rb")
+    if threaded is None:
+        threaded = size is None or size >= THREAD_THRESHOLD
+    if threaded:
+        stream = io.BufferedReader(ThreadedReader(_Closing(stream, buffered)),
+                                   buffer_size=BUFFER_SIZE)
+    else:
+        stream = io.BufferedReader(_Closing(stream, buffered),
+                                   buffer_size=BUFFER_SIZE)
+    return _text(stream, mode)
+
+
+def open_output(path, mode="wt", bgzf=None, level=6):
+    """
+    Open a file for writing; '-' is stdout.
+
+    :param path: file name or '-'
+    :param mode: 'wt' (default) or 'wb'
+    :param bgzf: write BGZF. When None, BGZF is written if path ends in
+        .gz or .bgz.
+    :param level: zlib compression level for BGZF output
+    :return: file-like object
+    """
+    if bgzf is None:
+        bgzf = path.endswith(".gz") or path.endswith(".bgz")
+    if path == "-":
+        raw = io.open(sys.stdout.fileno(), "wb", closefd=False)
+        sys.stdout.flush()
+    else:
+        raw = io.open(path, "wb")
+    if bgzf:
+        raw = BgzfWriter(raw, level=level)
+    return _text(io.BufferedWriter(raw, buffer_size=BUFFER_SIZE), mode)
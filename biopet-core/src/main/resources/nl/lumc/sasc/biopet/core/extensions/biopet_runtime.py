@@ -0,0 +1,293 @@
+#
+# Biopet is built on top of GATK Queue for building bioinformatic
+# pipelines. It is mainly intended to support LUMC SHARK cluster which is running
+# SGE. But other types of HPC that are supported by GATK Queue (such as PBS)
+# should also be able to execute Biopet tools and pipelines.
+#
+# Copyright 2014 Sequencing Analysis Support Core - Leiden University Medical Center
+#
+# Contact us at: sasc@lumc.nl
+#
+# A dual licensing mode is applied. The source code within this project is freely available for non-commercial use under an AGPL
+# license; For commercial users or users who do not want to follow the AGPL
+# license, please contact us to obtain a separate license.
+#
+
+"""
+Runtime helpers shared by the Python scripts bundled with Biopet.
+
+Heavy modules (matplotlib, pysam) should be imported through
+`lazy_import` / `pyplot` at the point they are needed, so runs that do not
+need them do not pay for them.
+
+When the BIOPET_IMPORT_TIME environment variable is set, scripts that call
+`report_import_time` append one JSON line to the file it names ('-' for
+stderr) when they exit:
+
+    {"script": ..., "startup": ..., "imports": {module: seconds}}
+
+`startup` is the time between process start and the call, i.e. interpreter
+start-up plus all top-level imports; `imports` holds the lazy imports.
+
+When BIOPET_PROFILE is set to an output prefix, scripts that call `init`
+run the rest of their main code under cProfile and write `<prefix>.prof`
+(pstats format) and `<prefix>.profile.json` (the top functions by
+cumulative time) at exit. BIOPET_PROFILE_MEMORY=1 additionally traces
+allocations with tracemalloc (Python 3 only) and adds the peak and the top
+allocation sites to the JSON summary; BIOPET_PROFILE_TOP sets the number of
+entries (default 30).
+
+When BIOPET_METRICS is set to a file name, scripts that call `init` write
+their runtime metrics to it as JSON at exit: wall time, CPU time (including
+waited-for child processes), peak RSS, the number of records processed as
+counted with `add_records`, and the throughput in records per second.
+PythonCommandLineFunction sets it for every job when the `metrics` option
+of the python namespace is enabled, so the metrics can be added to the
+summary. The peak RSS is the VmHWM of the process where /proc is
+available: ru_maxrss also counts the memory of the process the script was
+forked from, e.g. the benchmark driver or the preloaded worker server.
+
+Scripts call `init(__file__)` once, at the start of their main code, to
+enable all of the above.
+
+Works with both Python 2.7 and Python 3.
+"""
+
+from __future__ import print_function
+
+import atexit
+import collections
+import importlib
+import json
+import os
+import sys
+import time
+
+IMPORT_TIME_ENV = "BIOPET_IMPORT_TIME"
+PROFILE_ENV = "BIOPET_PROFILE"
+PROFILE_MEMORY_ENV = "BIOPET_PROFILE_MEMORY"
+PROFILE_TOP_ENV = "BIOPET_PROFILE_TOP"
+DEFAULT_PROFILE_TOP = 30
+METRICS_ENV = "BIOPET_METRICS"
+
+_import_times = collections.OrderedDict()
+_records = [0]
+
+
+def lazy_import(name):
+    """
+    Import a module by name, recording the time spent on the first import.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.time()
+    module = importlib.import_module(name)
+    _import_times[name] = time.time() - start
+    return module
+
+
+def pyplot():
+    """Import matplotlib.pyplot with the non-interactive Agg backend."""
+    if "matplotlib.pyplot" not in sys.modules:
+        lazy_import("matplotlib").use("Agg")
+    return lazy_import("matplotlib.pyplot")
+
+
+def process_age():
+    """
+    Seconds since the current process was started, or None when this
+    cannot be determined (only supported on Linux).
+    """
+    try:
+        with open("/proc/self/stat") as handle:
+            # the command name may contain spaces; fields resume after ')'
+            fields = handle.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as handle:
+            uptime = float(handle.read().split()[0])
+        ticks = os.sysconf(os.sysconf_names["SC_CLK_TCK"])
+        return max(0.0, uptime - float(fields[19]) / ticks)
+    except (IOError, OSError, IndexError, KeyError, ValueError):
+        return None
+
+
+def report_import_time(script):
+    """
+    Record the start-up time of a script, and write it together with the
+    lazy import times at exit when BIOPET_IMPORT_TIME is set.
+    """
+    target = os.environ.get(IMPORT_TIME_ENV)
+    if not target:
+        return
+    startup = process_age()
+
+    def write():
+        line = json.dumps({
+            "script": os.path.basename(script),
+            "startup": startup,
+            "imports": _import_times,
+        })
+        if target == "-":
+            print(line, file=sys.stderr)
+        else:
+            with open(target, "a") as handle:
+                handle.write(line + "\n")
+
+    atexit.register(write)
+
+
+def _function_name(key):
+    filename, line, name = key
+    if filename == "~":
+        # built-in functions
+        return name
+    return "{0}:{1}({2})".format(filename, line, name)
+
+
+def profile_summary(profiler, top, memory=False):
+    """Summarize a finished cProfile.Profile (and tracemalloc) as a dict."""
+    import pstats
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda x: x[1][3], reverse=True)
+    summary = {
+        "total_time": stats.total_tt,
+        "functions": [{
+            "function": _function_name(key),
+            "primitive_calls": cc,
+            "calls": nc,
+            "tottime": tt,
+            "cumtime": ct,
+        } for key, (cc, nc, tt, ct, _) in rows[:top]],
+    }
+    if memory:
+        import tracemalloc
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        summary["memory"] = {
+            "peak": peak,
+            "allocations": [{
+                "location": "{0}:{1}".format(stat.traceback[0].filename,
+                                             stat.traceback[0].lineno),
+                "size": stat.size,
+                "count": stat.count,
+            } for stat in snapshot.statistics("lineno")[:top]],
+        }
+    return summary
+
+
+def start_profile(prefix, memory=False, top=DEFAULT_PROFILE_TOP):
+    """
+    Profile the rest of the process and write <prefix>.prof and
+    <prefix>.profile.json at exit.
+    """
+    import cProfile
+    if memory:
+        try:
+            import tracemalloc
+            tracemalloc.start()
+        except ImportError:
+            print("tracemalloc is not available, not profiling memory",
+                  file=sys.stderr)
+            memory = False
+    profiler = cProfile.Profile()
+
+    def write():
+        profiler.disable()
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        profiler.dump_stats(prefix + ".prof")
+        summary = profile_summary(profiler, top, memory)
+        with open(prefix + ".profile.json", "w") as handle:
+            json.dump(summary, handle, indent=2)
+
+    atexit.register(write)
+    profiler.enable()
+
+
+def add_records(n=1):
+    """Count records processed by the script, for the runtime metrics."""
+    _records[0] += n
+
+
+def _vm_hwm():
+    """Peak resident set size of this process in bytes from /proc, or None."""
+    try:
+        with open("/proc/self/status") as handle:
+            for line in handle:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _peak_rss(children=False):
+    if not children:
+        peak = _vm_hwm()
+        if peak is not None:
+            return peak
+    import resource
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def runtime_metrics(script, started):
+    """
+    Runtime metrics of the current process as a dict; `started` is the
+    time.time() to measure the wall time from when the process start time
+    cannot be determined.
+    """
+    wall = process_age()
+    if wall is None:
+        wall = time.time() - started
+    times = os.times()
+    records = _records[0]
+    return collections.OrderedDict([
+        ("script", os.path.basename(script)),
+        ("wall_time", wall),
+        ("cpu_time", times[0] + times[1] + times[2] + times[3]),
+        ("user_time", times[0] + times[2]),
+        ("system_time", times[1] + times[3]),
+        ("peak_rss", _peak_rss()),
+        ("children_peak_rss", _peak_rss(children=True)),
+        ("records", records),
+        ("records_per_second", records / wall if wall > 0 else None),
+    ])
+
+
+def write_metrics(script, path):
+    """Write the runtime metrics of the script to path at exit."""
+    started = time.time()
+
+    def write():
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write to a temporary file first, so a reader never sees a partial file
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp, "w") as handle:
+            json.dump(runtime_metrics(script, started), handle, indent=2)
+        os.rename(temp, path)
+
+    atexit.register(write)
+
+
+def init(script):
+    """
+    Hook called by every script at the start of its main code; enables the
+    metrics, start-up reporting and profiling configured in the environment.
+    """
+    if script.endswith((".pyc", ".pyo")):
+        # run from bytecode, e.g. from the bundle archive
+        script = script[:-1]
+    report_import_time(script)
+    metrics = os.environ.get(METRICS_ENV)
+    if metrics:
+        write_metrics(script, metrics)
+    prefix = os.environ.get(PROFILE_ENV)
+    if prefix:
+        start_profile(prefix,
+                      memory=os.environ.get(PROFILE_MEMORY_ENV, "") not in ("", "0"),
+                      top=int(os.environ.get(PROFILE_TOP_ENV, DEFAULT_PROFILE_TOP)))
@@ -0,0 +1,439 @@
+#
+# Biopet is built on top of GATK Queue for building bioinformatic
+# pipelines. It is mainly intended to support LUMC SHARK cluster which is running
+# SGE. But other types of HPC that are supported by GATK Queue (such as PBS)
+# should also be able to execute Biopet tools and pipelines.
+#
+# Copyright 2014 Sequencing Analysis Support Core - Leiden University Medical Center
+#
+# Contact us at: sasc@lumc.nl
+#
+# A dual licensing mode is applied. The source code within this project is freely available for non-commercial use under an AGPL
+# license; For commercial users or users who do not want to follow the AGPL
+# license, please contact us to obtain a separate license.
+#
+
+"""
+Persistent per-node worker for the Python scripts bundled with Biopet.
+
+The server imports the heavy modules (numpy, matplotlib, pysam) once and
+listens on a Unix socket. For every request it forks a child that takes
+over the stdin, stdout and stderr of the client, changes to the client's
+working directory and environment, and runs the script as __main__. The
+client exits with the exit status of the script, so it can stand in for
+`python script.py args` in any command line:
+
+    python biopet_worker.py [--socket PATH] [--idle-timeout SEC] serve
+    python biopet_worker.py [--socket PATH] run [--spawn] script.py args...
+
+With --spawn, `run` starts a detached server when none is listening. When
+no server can be reached, `run` executes the script in its own
+interpreter, so the worker is never required for correctness.
+
+The socket lives in a directory only the user can access, and both sides
+check that the other end belongs to the same user before anything is
+sent. The scripts run as children of the server, so they are not in the
+process group or cgroup of the scheduler job: a killed client makes the
+server kill the script, but memory and cpu limits of the job do not apply
+to it, unless the cgroup of the client can be joined (cgroup v2 with a
+delegated hierarchy). Helper modules the server loaded from another
+directory are dropped before a script runs, so the script imports the
+ones next to it.
+
+The server needs Python 3; Python 2 clients always run the script directly.
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+import traceback
+
+DEFAULT_PRELOAD = "numpy,matplotlib.pyplot,pysam"
+DEFAULT_IDLE_TIMEOUT = 600
+# seconds a client waits for a server it spawned to come up
+SPAWN_TIMEOUT = 30
+HEADER = struct.Struct("!I")
+STATUS = struct.Struct("!i")
+STDIO_FDS = (0, 1, 2)
+
+
+def default_socket():
+    return os.path.join("/tmp", "biopet-worker-{0}".format(os.getuid()), "worker.sock")
+
+
+def _private_dir(path):
+    """
+    Create the directory of the socket, accessible by this user only.
+    Returns False when it exists but is owned by another user or is
+    accessible by others.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(directory)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def _peer_uid(conn):
+    """User id of the other end of a Unix socket, None when unknown."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+
+def _trusted(conn, path):
+    """The socket and the process at the other end belong to this user."""
+    try:
+        owner = os.stat(path).st_uid
+    except OSError:
+        return False
+    peer = _peer_uid(conn)
+    return owner == os.getuid() and peer in (None, os.getuid())
+
+
+def can_pass_fds():
+    return hasattr(socket.socket, "sendmsg")
+
+
+def _recv_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError("connection closed by peer")
+        data += chunk
+    return data
+
+
+def _preload(names):
+    import biopet_runtime
+    for name in names:
+        try:
+            if name == "matplotlib.pyplot":
+                biopet_runtime.pyplot()
+            else:
+                biopet_runtime.lazy_import(name)
+        except ImportError as e:
+            print("Not preloading {0}: {1}".format(name, e), file=sys.stderr)
+
+
+def _join_cgroup(cgroup):
+    """Move this process into the (cgroup v2) cgroup of the client, when allowed."""
+    if not cgroup or cgroup == _client_cgroup():
+        return
+    try:
+        with open(os.path.join("/sys/fs/cgroup", cgroup.lstrip("/"),
+                               "cgroup.procs"), "w") as handle:
+            handle.write(str(os.getpid()))
+    except (IOError, OSError) as e:
+        print("biopet worker: script not in the cgroup of the job, its "
+              "resource limits do not apply ({0})".format(e), file=sys.stderr)
+
+
+def _client_cgroup():
+    """Cgroup v2 path of this process, None when there is none."""
+    try:
+        with open("/proc/self/cgroup") as handle:
+            for line in handle:
+                if line.startswith("0::"):
+                    return line[3:].strip()
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _drop_foreign_modules(script_dir):
+    """
+    Forget modules the server imported from its own directory when the
+    script lives elsewhere, so the helper modules next to the script are used.
+    """
+    server_dir = os.path.dirname(os.path.abspath(__file__))
+    if server_dir == script_dir:
+        return
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, "__file__", None)
+        if filename and os.path.dirname(os.path.abspath(filename)) == server_dir:
+            del sys.modules[name]
+
+
+def _run_script(request):
+    """Run a requested script in the current (forked) process; returns exit code."""
+    _join_cgroup(request.get("cgroup"))
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    script = request["script"]
+    sys.argv = [script] + request["argv"]
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    _drop_foreign_modules(sys.path[0])
+    import runpy
+    try:
+        runpy.run_path(script, run_name="__main__")
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    try:
+        import atexit
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except BaseException:
+        traceback.print_exc()
+    return code
+
+
+def _wait(conn, pid):
+    """
+    Wait for the script to exit, killing it when the client goes away, e.g.
+    because the scheduler killed the job.
+    """
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return status
+        readable, _, _ = select.select([conn], [], [], 1.0)
+        try:
+            gone = readable and not conn.recv(1)
+        except socket.error:
+            gone = True
+        if gone:
+            os.kill(pid, signal.SIGKILL)
+            return os.waitpid(pid, 0)[1]
+
+
+def _handle(conn):
+    """Handle one client connection in a forked handler process."""
+    if _peer_uid(conn) not in (None, os.getuid()):
+        raise RuntimeError("refusing connection of another user")
+    msg, ancdata, _, _ = conn.recvmsg(HEADER.size,
+                                      socket.CMSG_LEN(len(STDIO_FDS) * 4))
+    fds = []
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.extend(struct.unpack("{0}i".format(len(data) // 4), data))
+    (size,) = HEADER.unpack(msg + _recv_exact(conn, HEADER.size - len(msg)))
+    request = json.loads(_recv_exact(conn, size).decode("utf-8"))
+
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for target, fd in zip(STDIO_FDS, fds):
+            os.dup2(fd, target)
+        for fd in fds:
+            os.close(fd)
+        os._exit(_run_script(request))
+
+    for fd in fds:
+        os.close(fd)
+    conn.sendall(STATUS.pack(pid))
+    status = _wait(conn, pid)
+    if os.WIFSIGNALED(status):
+        code = 128 + os.WTERMSIG(status)
+    else:
+        code = os.WEXITSTATUS(status)
+    try:
+        conn.sendall(STATUS.pack(code))
+    except socket.error:
+        # the client is gone
+        pass
+
+
+def _bind(path):
+    if not _private_dir(path):
+        raise RuntimeError("directory of {0} is not private to this user".format(path))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        listener.bind(path)
+    except socket.error as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        if _connect(path) is not None:
+            # another server already owns this socket
+            listener.close()
+            return None
+        os.remove(path)
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    return listener
+
+
+def serve(path, preload, idle_timeout):
+    _preload(preload)
+    listener = _bind(path)
+    if listener is None:
+        return 0
+    inode = os.stat(path).st_ino
+    listener.listen(128)
+    listener.settimeout(1.0)
+    handlers = set()
+    last_active = time.time()
+    try:
+        while True:
+            for pid in list(handlers):
+                if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                    handlers.discard(pid)
+            if handlers:
+                last_active = time.time()
+            elif time.time() - last_active > idle_timeout:
+                break
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                continue
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                listener.close()
+                code = 1
+                try:
+                    conn.settimeout(None)
+                    _handle(conn)
+                    code = 0
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(code)
+            conn.close()
+            handlers.add(pid)
+    finally:
+        listener.close()
+        # only clean up the socket when it was not taken over in the meantime
+        try:
+            if os.stat(path).st_ino == inode:
+                os.remove(path)
+        except OSError:
+            pass
+    return 0
+
+
+def _connect(path):
+    if not os.path.exists(path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except socket.error:
+        conn.close()
+        return None
+    if not _trusted(conn, path):
+        print("Not using biopet worker at {0}: it belongs to another "
+              "user".format(path), file=sys.stderr)
+        conn.close()
+        return None
+    return conn
+
+
+def _spawn(path, preload, idle_timeout):
+    """Start a detached server and wait until it accepts connections."""
+    if not _private_dir(path):
+        return None
+    with open(os.devnull, "r+") as devnull, open(path + ".log", "a") as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                          "--socket", path, "--preload", ",".join(preload),
+                          "--idle-timeout", str(idle_timeout), "serve"],
+                         stdin=devnull, stdout=devnull, stderr=log,
+                         close_fds=True, preexec_fn=os.setsid)
+    deadline = time.time() + SPAWN_TIMEOUT
+    while time.time() < deadline:
+        conn = _connect(path)
+        if conn is not None:
+            return conn
+        time.sleep(0.1)
+    return None
+
+
+def run(path, script, argv, spawn, preload, idle_timeout):
+    conn = None
+    if can_pass_fds():
+        conn = _connect(path)
+        if conn is None and spawn:
+            conn = _spawn(path, preload, idle_timeout)
+    if conn is None:
+        os.execv(sys.executable, [sys.executable, script] + argv)
+
+    request = json.dumps({
+        "script": os.path.abspath(script),
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        "cgroup": _client_cgroup(),
+    }).encode("utf-8")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    fds = struct.pack("{0}i".format(len(STDIO_FDS)), *STDIO_FDS)
+    conn.sendmsg([HEADER.pack(len(request))],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+    conn.sendall(request)
+
+    try:
+        (pid,) = STATUS.unpack(_recv_exact(conn, STATUS.size))
+
+        def forward(signum, frame):
+            os.kill(pid, signum)
+
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, forward)
+        (code,) = STATUS.unpack(_recv_exact(conn, STATUS.size))
+    except EOFError:
+        print("Lost connection to biopet worker at {0}".format(path),
+              file=sys.stderr)
+        code = 1
+    conn.close()
+    return code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--socket", default=default_socket(),
+                        help="Path of the Unix socket (default: %(default)s)")
+    parser.add_argument("--preload", default=DEFAULT_PRELOAD,
+                        help="Comma separated modules the server imports at "
+                             "start-up (default: %(default)s)")
+    parser.add_argument("--idle-timeout", type=int, default=DEFAULT_IDLE_TIMEOUT,
+                        help="Seconds without requests after which the server "
+                             "exits (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    subparsers.add_parser("serve", help="Run the worker server")
+    run_parser = subparsers.add_parser("run", help="Run a script in the worker")
+    run_parser.add_argument("--spawn", action="store_true",
+                            help="Start a server when none is running")
+    run_parser.add_argument("script")
+    run_parser.add_argument("args", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    preload = [x for x in args.preload.split(",") if x]
+    if args.command == "serve":
+        sys.exit(serve(args.socket, preload, args.idle_timeout))
+    else:
+        sys.exit(run(args.socket, args.script, args.args, args.spawn,
+                     preload, args.idle_timeout))
@@ -14,12 +14,15 @@
   */
 package nl.lumc.sasc.biopet.core.extensions
 
-import java.io.{File, FileOutputStream}
+import java.io.{File, FileOutputStream, IOException}
 
+import nl.lumc.sasc.biopet.FullVersion
 import nl.lumc.sasc.biopet.core.BiopetCommandLineFunction
-import nl.lumc.sasc.biopet.utils.Logging
-import org.broadinstitute.gatk.utils.commandline.Input
+import nl.lumc.sasc.biopet.utils.{ConfigUtils, IoUtils, Logging}
+import org.broadinstitute.gatk.utils.commandline.{Input, Output}
 import scala.collection.mutable
+import scala.sys.process.{Process, ProcessLogger}
+import scala.util.Try
 
 trait PythonCommandLineFunction extends BiopetCommandLineFunction {
   @Input(doc = "Python script", required = false)
@@ -27,21 +30,81 @@ trait PythonCommandLineFunction extends BiopetCommandLineFunction {
 
   executable = config("exe", default = "python", namespace = "python", freeVar = false)
 
+  /**
+    * When set, scripts are run through a persistent per-node worker that has the heavy modules
+    * preloaded. The scripts then run outside the cgroup of the job, so scheduler memory limits
+    * do not apply to them.
+    */
+  val pythonWorker: Boolean = config("worker", default = false, namespace = "python", freeVar = false)
+  val pythonWorkerSocket: Option[String] =
+    config("worker_socket", namespace = "python", freeVar = false)
+
+  /** Opt-in cProfile (and tracemalloc) profiling of the script, written next to the job output */
+  val pythonProfile: Boolean = config("profile", default = false, namespace = "python", freeVar = false)
+  val pythonProfileMemory: Boolean =
+    config("profile_memory", default = false, namespace = "python", freeVar = false)
+  val pythonProfileTop: Option[Int] = config("profile_top", namespace = "python", freeVar = false)
+
+  /**
+    * Opt-in runtime metrics (wall and cpu time, peak rss, records processed) of the script, see
+    * biopet_runtime.py. Off by default, as it adds a sidecar file to every python job.
+    */
+  val pythonMetrics: Boolean =
+    config("metrics", default = false, namespace = "python", freeVar = false)
+
+  /** Sidecar json the script writes its metrics to, defaults to a file next to the job output */
+  @Output(doc = "Python runtime metrics", required = false)
+  var pythonMetricsFile: Option[File] = None
+
+  /**
+    * Run bundled scripts from one archive with precompiled bytecode that is built once per run,
+    * instead of extracting and compiling each script, see biopet_bundle.py and
+    * biopet_bundle_build.py.
+    * The worker, when enabled, takes precedence.
+    */
+  val pythonBundle: Boolean = config("bundle", default = false, namespace = "python", freeVar = false)
+
+  /** Name of the script inside the bundle, set when pythonScript is the bundle archive */
+  protected var pythonBundleCommand: Option[String] = None
+
   protected var pythonScriptName: String = _
 
+  /** Directory with the helper modules, when they are not next to the script */
+  protected var pythonHelperDir: Option[File] = None
+
+  /**
+    * Use the bundle archive for a script when enabled and the script is part of it
+    * @param script name of script in jar
+    * @return true when the script is run from the bundle
+    */
+  protected def setBundledScript(script: String): Boolean = {
+    if (pythonBundle && !pythonWorker && PythonCommandLineFunction.isBundled(script)) {
+      PythonCommandLineFunction.bundle(executable) match {
+        case Some(archive) =>
+          pythonScriptName = script
+          pythonScript = archive
+          pythonBundleCommand = Some(script.stripSuffix(".py"))
+          true
+        case _ => false
+      }
+    } else false
+  }
+
   /**
     * checks if script already exist in jar otherwise try to fetch from the jar
     * @param script name / location of script
     */
   def setPythonScript(script: String) {
-    pythonScript = new File(script).getAbsoluteFile
-    if (!PythonCommandLineFunction.alreadyCopied.contains((this.getClass, script))) {
-      setPythonScript(script, "")
-      this.getClass
-      PythonCommandLineFunction.alreadyCopied += (this.getClass, script) -> pythonScript
-    } else {
-      pythonScriptName = script
-      pythonScript = PythonCommandLineFunction.alreadyCopied((this.getClass, script))
+    if (!setBundledScript(script)) {
+      pythonScript = new File(script).getAbsoluteFile
+      if (!PythonCommandLineFunction.alreadyCopied.contains((this.getClass, script))) {
+        setPythonScript(script, "")
+        this.getClass
+        PythonCommandLineFunction.alreadyCopied += (this.getClass, script) -> pythonScript
+      } else {
+        pythonScriptName = script
+        pythonScript = PythonCommandLineFunction.alreadyCopied((this.getClass, script))
+      }
     }
   }
 
@@ -52,8 +115,14 @@ trait PythonCommandLineFunction extends BiopetCommandLineFunction {
     */
   def setPythonScript(script: String, subpackage: String) {
     pythonScriptName = script
-    if (new File(script).isAbsolute && new File(script).exists()) {
+    if (setBundledScript(script)) {
+      // run from the bundle archive, nothing to extract
+    } else if (new File(script).isAbsolute && new File(script).exists()) {
       pythonScript = new File(script)
+      // a user supplied script, the helper modules are put on the PYTHONPATH
+      val helperDir = new File(".queue/tmp/python_helpers").getAbsoluteFile
+      PythonCommandLineFunction.extractHelperModules(helperDir)
+      pythonHelperDir = Some(helperDir)
     } else {
       pythonScript = new File(".queue/tmp/" + subpackage + pythonScriptName).getAbsoluteFile
       if (!pythonScript.getParentFile.exists) pythonScript.getParentFile.mkdirs
@@ -63,15 +132,153 @@ trait PythonCommandLineFunction extends BiopetCommandLineFunction {
         org.apache.commons.io.IOUtils.copy(is, os)
         os.close()
       } else Logging.addError(s"Python script not found: $pythonScriptName")
+      PythonCommandLineFunction.extractHelperModules(pythonScript.getParentFile)
     }
   }
 
+  /** Prefix of the <prefix>.prof and <prefix>.profile.json files written when profiling */
+  def pythonProfilePrefix: File = Option(jobOutputFile) match {
+    case Some(out) => new File(out.getAbsolutePath.stripSuffix(".out") + ".python")
+    case _ => new File(pythonScriptName + ".python")
+  }
+
+  /** Metrics file used on the command line, None when disabled or no location is known */
+  protected def pythonMetricsTarget: Option[File] =
+    if (pythonMetrics)
+      pythonMetricsFile.orElse(Option(jobOutputFile).map(out =>
+        new File(out.getAbsolutePath.stripSuffix(".out") + ".python.metrics.json")))
+    else None
+
+  /** Metrics written by the script, empty when there are none (yet) or they are incomplete */
+  def pythonMetricsSummary: Map[String, Any] =
+    pythonMetricsTarget
+      .filter(_.exists())
+      .flatMap(file => Try(ConfigUtils.fileToConfigMap(file)).toOption)
+      .filter(metrics => PythonCommandLineFunction.metricsKeys.forall(metrics.contains))
+      .getOrElse(Map())
+
+  /** Environment settings for the profiling hook of the scripts, see biopet_runtime.py */
+  protected def pythonProfileEnv: String =
+    if (pythonProfile)
+      required("BIOPET_PROFILE=", pythonProfilePrefix, spaceSeparated = false) +
+        conditional(pythonProfileMemory, "BIOPET_PROFILE_MEMORY=1") +
+        optional("BIOPET_PROFILE_TOP=", pythonProfileTop, spaceSeparated = false)
+    else ""
+
   /** return basic command to prefix the complete command with */
   def getPythonCommand: String = {
-    required(executable) + required(pythonScript)
+    val workerClient = new File(pythonScript.getParentFile, "biopet_worker.py")
+    val env = pythonHelperDir
+      .map(
+        dir =>
+          required("PYTHONPATH=",
+                   dir,
+                   suffix = "${PYTHONPATH:+:$PYTHONPATH}",
+                   spaceSeparated = false,
+                   escape = false))
+      .getOrElse("") +
+      optional("BIOPET_METRICS=", pythonMetricsTarget, spaceSeparated = false) +
+      pythonProfileEnv
+    if (pythonWorker && workerClient.exists())
+      env +
+        required(executable) +
+        required(workerClient) +
+        optional("--socket", pythonWorkerSocket) +
+        " run --spawn " +
+        required(pythonScript)
+    else env + required(executable) + required(pythonScript) +
+      pythonBundleCommand.map(required(_)).getOrElse("")
   }
 }
 
 object PythonCommandLineFunction {
   private val alreadyCopied: mutable.Map[(Class[_], String), File] = mutable.Map()
+
+  /** Shared python modules that are placed next to each extracted script */
+  val helperModules: List[String] =
+    List("biopet_io.py", "biopet_grid.py", "biopet_runtime.py", "biopet_worker.py")
+
+  private val helperDirs: mutable.Set[File] = mutable.Set()
+
+  /** Keys every complete metrics file has, see runtime_metrics in biopet_runtime.py */
+  val metricsKeys: List[String] =
+    List("script", "wall_time", "cpu_time", "peak_rss", "records")
+
+  /** Scripts included in the bundle archive, as resource paths */
+  val bundledScripts: List[String] = List(
+    "/nl/lumc/sasc/biopet/pipelines/bammetrics/scripts/bedtools_cov_stats.py",
+    "/nl/lumc/sasc/biopet/extensions/breakdancer/breakdancer2vcf.py",
+    "/nl/lumc/sasc/biopet/extensions/freec/freec_CNVPlot.py",
+    "/nl/lumc/sasc/biopet/extensions/samtools/fix_iupac_mpileup.py",
+    "/nl/lumc/sasc/biopet/extensions/varscan/fix_mpileup.py",
+    "/nl/lumc/sasc/biopet/pipelines/mapping/scripts/tophat-recondition.py",
+    "/nl/lumc/sasc/biopet/pipelines/tarmac/scripts/bed_threshold.py",
+    "/nl/lumc/sasc/biopet/pipelines/tarmac/scripts/find_all_common.py",
+    "/nl/lumc/sasc/biopet/pipelines/tarmac/scripts/select_sample_from_matrix.py",
+    "/nl/lumc/sasc/biopet/pipelines/tarmac/scripts/tarmac_plot.py"
+  )
+
+  def isBundled(script: String): Boolean = bundledScripts.exists(_.endsWith("/" + script))
+
+  /** Bundle archive per python executable, None when building it failed */
+  private val bundles: mutable.Map[String, Option[File]] = mutable.Map()
+
+  /**
+    * Bundle archive of all bundled scripts, built once per run with the given python executable
+    * @param executable python executable that runs the jobs
+    */
+  def bundle(executable: String): Option[File] = synchronized {
+    bundles.getOrElseUpdate(executable, buildBundle(executable))
+  }
+
+  private def buildBundle(executable: String): Option[File] = {
+    val tmpDir = new File(".queue/tmp").getAbsoluteFile
+    val sourceDir = new File(tmpDir, "python_bundle")
+    def extract(resource: String): Option[File] =
+      Option(getClass.getResourceAsStream(resource)).map { is =>
+        val file = new File(sourceDir, new File(resource).getName)
+        IoUtils.copyStreamToFile(is, file, createDirs = true)
+        file
+      }
+    // the builder imports the runtime part of the bundle, biopet_bundle.py, from its directory
+    val builder = extract("biopet_bundle_build.py")
+    extract("biopet_bundle.py")
+    val modules = helperModules.flatMap(extract)
+    val scripts = bundledScripts.flatMap(extract)
+    val hash = executable.hashCode.toHexString
+    val version = FullVersion.replaceAll("[^A-Za-z0-9.-]+", "_").stripSuffix("_")
+    val archive = new File(tmpDir, s"biopet-python-$version-$hash.pyz")
+    val cmd = Seq(executable,
+                  builder.map(_.getAbsolutePath).getOrElse("biopet_bundle_build.py"),
+                  "-o",
+                  archive.getAbsolutePath,
+                  "--version",
+                  FullVersion) ++
+      modules.flatMap(m => Seq("-m", m.getAbsolutePath)) ++ scripts.map(_.getAbsolutePath)
+    val stderr = new StringBuffer()
+    val exitcode =
+      try Process(cmd).!(ProcessLogger(_ => (), stderr append _ + "\n"))
+      catch { case e: IOException => stderr.append(e.getMessage); -1 }
+    if (exitcode == 0 && archive.exists()) Some(archive)
+    else {
+      Logging.logger.warn(
+        s"Could not build python bundle with '$executable', scripts are extracted instead: $stderr")
+      None
+    }
+  }
+
+  /**
+    * Extract the shared helper modules into a directory, once per directory
+    * @param dir directory the python scripts are extracted to
+    */
+  def extractHelperModules(dir: File): Unit = synchronized {
+    if (!helperDirs.contains(dir)) {
+      helperModules.foreach { module =>
+        val is = getClass.getResourceAsStream(module)
+        if (is != null) IoUtils.copyStreamToFile(is, new File(dir, module), createDirs = true)
+        else Logging.addError(s"Python helper module not found: $module")
+      }
+      helperDirs += dir
+    }
+  }
 }
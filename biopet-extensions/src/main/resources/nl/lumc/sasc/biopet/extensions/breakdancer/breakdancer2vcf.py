@@ -25,59 +25,136 @@ __created__ = "Mar 18, 2013"
 __author__ = "tbeek,wyleung"
 
 import argparse
-import csv
 import datetime
+import itertools
+import mmap
+import operator
+import os
 
+import biopet_io
+import biopet_runtime
 
-def main(tsvfile, vcffile, samplename):
+
+class IndexedReference(object):
+    '''
+    Random access to the bases of a FASTA file using its .fai index.
+
+    The FASTA file is memory-mapped, so a lookup is a constant time index
+    computation and the genome is never read as a whole; the operating
+    system only pages in the parts that are accessed. Bases are cached per
+    contig.
     '''
-    :param tsvfile: filename of input file.tsv
+
+    def __init__(self, fasta):
+        '''
+        :param fasta: filename of the FASTA file; fasta + '.fai' must exist
+        :type fasta: string
+        '''
+        fai = fasta + '.fai'
+        if not os.path.exists(fai):
+            raise IOError('Reference index not found: {0} '
+                          '(create it with samtools faidx)'.format(fai))
+        self.fasta = fasta
+        # name -> (length, offset, bases per line, bytes per line)
+        self._index = {}
+        with open(fai) as reader:
+            for line in reader:
+                fields = line.rstrip('\n').split('\t')
+                self._index[fields[0]] = tuple(int(x) for x in fields[1:5])
+        self._handle = open(fasta, 'rb')
+        self._map = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self._cache = {}
+
+    def base(self, chrom, pos):
+        '''
+        Return the upper case base at a 1-based position, or 'N' when the
+        contig or position is not in the reference.
+        '''
+        cache = self._cache.get(chrom)
+        if cache is None:
+            cache = self._cache[chrom] = {}
+        base = cache.get(pos)
+        if base is None:
+            base = cache[pos] = self._fetch(chrom, pos)
+        return base
+
+    def _fetch(self, chrom, pos):
+        if chrom not in self._index:
+            return 'N'
+        length, offset, line_bases, line_width = self._index[chrom]
+        if not 1 <= pos <= length:
+            return 'N'
+        i = pos - 1
+        at = offset + (i // line_bases) * line_width + i % line_bases
+        return self._map[at:at + 1].decode('ascii').upper()
+
+    def close(self):
+        self._map.close()
+        self._handle.close()
+
+
+def main(tsvfile, vcffile, samplename, reference=None, min_score=None, min_reads=None):
+    '''
+    :param tsvfile: filename of input file.tsv, '-' for stdin
     :type tsvfile: string
     :param vcffile: filename of output file.vcf
     :type vcffile: string
     :param samplename: Name of the sample
     :type samplename: string
+    :param reference: filename of the indexed reference FASTA (optional)
+    :type reference: string
+    :param min_score: skip calls with a lower Score (optional)
+    :type min_score: int
+    :param min_reads: skip calls supported by fewer reads (optional)
+    :type min_reads: int
     '''
-    with open(tsvfile) as reader:
-        # Parse file
-        dictreader = _parse_tsvfile(reader)
+    ref = IndexedReference(reference) if reference else None
+    try:
+        with biopet_io.open_input(tsvfile) as reader:
+            # Parse file
+            rows = _parse_tsvfile(reader)
 
-        # Write out file
-        _format_vcffile(dictreader, vcffile, samplename)
+            # Write out file
+            _format_vcffile(rows, vcffile, samplename, ref, min_score, min_reads)
+    finally:
+        if ref is not None:
+            ref.close()
 
 def _parse_tsvfile(readable):
     '''
-    Read readable using csv.Sniffer and csv.DictReader
-    :param readable: open file.tsv handle to read with csv.DictReader
+    Read the calls of readable as tuples of the _tsv_columns fields; the
+    last '#' line before the data, without the hash sign, holds the column
+    names. The column positions are looked up once, and the input is only
+    read forward, so it can be a pipe.
+    :param readable: open file.tsv handle
     :type readable: file
     '''
-    prev, curr = 0, 0
-    while True:
-        line = readable.readline()
+    header = None
+    first = None
+    for line in readable:
         if not line.startswith('#'):
-            # lets start from prev # line, without the hash sign
-            readable.seek(prev + 1)
+            first = line
             break
-        else:
-            prev = curr
-            curr = readable.tell()
+        header = line[1:]
 
-    # Determine dialect
-    curr = readable.tell()
-    #dialect = csv.Sniffer().sniff(readable.read(3000))
-    dialect = 'excel-tab'
-    readable.seek(curr)
+    if header is None:
+        # no comment header: the first line holds the column names
+        header, first = first, None
+    if header is None:
+        return iter(())
+    names = header.rstrip('\r\n').split('\t')
+    missing = [x for x in _tsv_columns if x not in names]
+    if missing:
+        raise ValueError('Column(s) missing from breakdancer output: ' + ', '.join(missing))
+    get = operator.itemgetter(*[names.index(x) for x in _tsv_columns])
 
-    # Read file
-    dictreader = csv.DictReader(readable, dialect=dialect)
-    return dictreader
+    lines = readable if first is None else itertools.chain([first], readable)
+    return (get(line.rstrip('\r\n').split('\t')) for line in lines if line.strip())
 
 
-_tsv_fields = ('Chr1', 'Pos1', 'Orientation1',
-               'Chr2', 'Pos2', 'Orientation2',
-               'Type', 'Size', 'Score',
-               'num_Reads', 'num_Reads_lib',
-               'ERR031544.sort.bam')
+# columns used, in the order _parse_tsvfile returns them
+_tsv_columns = ('Chr1', 'Pos1', 'Chr2', 'Pos2', 'Type', 'Size', 'Score', 'num_Reads')
+# example of a full record:
 # 'Chr1': '1',
 # 'Pos1': '269907',
 # 'Orientation1': '39+39-',
@@ -140,57 +217,84 @@ VCF_HEADER = """##fileformat=VCFv4.2
 ##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">
 ##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">""".format( filedate=TS_NOW.strftime( "%Y%m%d" ) )
 
-def _format_vcffile(dictreader, vcffile, samplename):
+# number of records formatted and written at a time
+BATCH_SIZE = 10000
+
+
+def _vcf_records(rows, ref=None, min_score=None, min_reads=None):
     '''
-    Create a pseudo .vcf file based on values read from DictReader instance.
-    :param dictreader: DictReader instance to read data from
-    :type dictreader: csv.DictRedaer
-    :param vcffile: output file.vcf filename
-    :type vcffile: string
+    Convert parsed calls to (CHROM, POS, REF, ALT, INFO, SAMPLEINFO) tuples,
+    skipping calls below the score or read support thresholds before doing
+    anything else with them.
+    :param rows: calls as returned by _parse_tsvfile
+    :param ref: reference to take the REF bases from; 'N' is used without
+    :type ref: IndexedReference
     '''
-    FORMAT = "GT:DP"
-    with open(vcffile, mode='w') as writer:
-        writer.write('{header}\n#{columns}\n'.format(header=VCF_HEADER, columns='\t'.join(_vcf_fields + [samplename])))
-        output_vcf = []
-        for line in dictreader:
-            CHROM = line['Chr1']
-            # TODO Figure out whether we have zero or one based positioning
-            POS = int(line['Pos1'])
-            ALT = '<{}>'.format(line['Type'])
-            SVEND = int(line['Pos2'])
-
-            INFO = 'SVMETHOD=breakdancer;SVTYPE={}'.format(line['Type'])
-
-            if line['Type'] not in ['CTX']:
-                INFO += ';SVLEN={}'.format(int(line['Size']))
-                INFO += ";SVEND={}".format(SVEND)
-                INFO += ";END={}".format(SVEND)
-
+    count = 0
+    for chrom, pos1, chrom2, pos2, svtype, size, score, reads in rows:
+        count += 1
+        if min_score is not None and int(score) < min_score:
+            continue
+        if min_reads is not None and int(reads) < min_reads:
+            continue
+        # TODO Figure out whether we have zero or one based positioning
+        pos = int(pos1)
+        svend = int(pos2)
+        base = ref.base(chrom, pos) if ref is not None else 'N'
+        if svtype == 'CTX':
             # write alternate ALT field for Intrachromosomal translocations
-            if line['Type'] in ['CTX']:
-                ALT = "N[{}:{}[".format(line['Chr2'], line['Pos2'])
-
-
+            alt = '{0}[{1}:{2}['.format(base, chrom2, pos2)
+            info = 'SVMETHOD=breakdancer;SVTYPE=CTX'
+        else:
+            alt = '<' + svtype + '>'
+            info = 'SVMETHOD=breakdancer;SVTYPE=%s;SVLEN=%d;SVEND=%d;END=%d' % (
+                svtype, int(size), svend, svend)
+        yield chrom, pos, base, alt, info, '1/.:' + reads
+    biopet_runtime.add_records(count)
 
-            SAMPLEINFO = "{}:{}".format( '1/.', line['num_Reads'] )
-            # Create record
-            output_vcf.append([CHROM, POS, '.', 'N', ALT, '.', 'PASS', INFO, FORMAT, SAMPLEINFO])
 
-        # Sort all results
-        output_vcf.sort()
-        output = "\n".join(["\t".join(map(str,vcf_row)) for vcf_row in output_vcf])
-        # Write record
-        writer.write(output)
+def _format_vcffile(rows, vcffile, samplename, ref=None, min_score=None, min_reads=None):
+    '''
+    Create a pseudo .vcf file based on the calls parsed by _parse_tsvfile.
+    :param rows: calls as returned by _parse_tsvfile
+    :param vcffile: output file.vcf filename
+    :type vcffile: string
+    :param ref: reference to take the REF bases from; 'N' is used without
+    :type ref: IndexedReference
+    :param min_score: skip calls with a lower Score (optional)
+    :param min_reads: skip calls supported by fewer reads (optional)
+    '''
+    header = VCF_HEADER
+    if ref is not None:
+        header += '\n##reference=file://{}'.format(os.path.abspath(ref.fasta))
+    # sort all results; the other columns are the same for every record
+    records = sorted(_vcf_records(rows, ref, min_score, min_reads))
+    line = '%s\t%d\t.\t%s\t%s\t.\tPASS\t%s\tGT:DP\t%s'
+    with open(vcffile, mode='w') as writer:
+        writer.write('{header}\n#{columns}\n'.format(header=header, columns='\t'.join(_vcf_fields + [samplename])))
+        for i in range(0, len(records), BATCH_SIZE):
+            if i:
+                writer.write('\n')
+            writer.write('\n'.join([line % record for record in records[i:i + BATCH_SIZE]]))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--breakdancertsv', dest='breakdancertsv', type=str,
-                        help='Breakdancer TSV outputfile')
+                        help='Breakdancer TSV outputfile, \'-\' for stdin')
     parser.add_argument('-o', '--outputvcf', dest='outputvcf', type=str,
                         help='Output vcf to')
     parser.add_argument('-s', '--sample', dest='sample', type=str,
                         help='sample name')
+    parser.add_argument('-r', '--reference', dest='reference', type=str,
+                        help='Reference FASTA with .fai index; used to fill in the REF '
+                             'bases, which are N otherwise')
+    parser.add_argument('--min-score', dest='min_score', type=int,
+                        help='Skip calls with a lower Score')
+    parser.add_argument('--min-reads', dest='min_reads', type=int,
+                        help='Skip calls supported by fewer reads (num_Reads)')
 
     args = parser.parse_args()
-    main(args.breakdancertsv, args.outputvcf, args.sample)
+    biopet_runtime.init(__file__)
+    main(args.breakdancertsv, args.outputvcf, args.sample, args.reference,
+         args.min_score, args.min_reads)
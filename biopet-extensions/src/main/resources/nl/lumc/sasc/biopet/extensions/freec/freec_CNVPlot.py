@@ -14,108 +14,146 @@
 #
 
 import argparse
+import collections
+import multiprocessing
 from os.path import join
 
 import numpy as np
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+
+import biopet_io
+import biopet_runtime
+
+# above this number of windows per chromosome, "auto" rendering switches
+# from a scatter plot to a density raster
+DENSITY_THRESHOLD = 50000
+# edge length, in screen pixels, of a single density raster bin
+DENSITY_PIXELS = 3
 
 
 class BamRatioReader(object):
     """
     Reader object for bam_ratio.txt files
+
+    The file is read once, on first access, into typed per-chromosome
+    arrays of start position, ratio and copy number.
     """
 
     def __init__(self, filename):
         self.filename = filename
-        self.__handle = open(filename)
-
-
-    def __reset_handle(self):
-        self.__handle.close()
-        self.__handle = open(self.filename)
+        self.__data = None
+
+    def __load(self):
+        columns = collections.OrderedDict()
+        with biopet_io.open_input(self.filename) as handle:
+            for line in handle:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 3 or fields[0] == "Chromosome":
+                    continue
+                chrom_columns = columns.get(fields[0])
+                if chrom_columns is None:
+                    chrom_columns = columns[fields[0]] = ([], [], [])
+                chrom_columns[0].append(fields[1])
+                chrom_columns[1].append(fields[2])
+                chrom_columns[2].append(fields[-1])
+
+        data = collections.OrderedDict()
+        for chromosome, (starts, ratios, cns) in columns.items():
+            # string -> number conversion of whole columns is done by numpy
+            data[chromosome] = (np.array(starts).astype(np.int64),
+                                np.array(ratios).astype(np.float64),
+                                np.array(cns).astype(np.int64))
+        return data
 
+    @property
+    def data(self):
+        if self.__data is None:
+            self.__data = self.__load()
+        return self.__data
 
     def get_chromosome(self, chromosome):
-        self.__reset_handle()
-        lines = []
-        for line in self.__handle:
-            if line.split("\t")[0] == chromosome:
-                lines.append(line)
-        return lines
+        """
+        Return (start, ratio, cn) arrays of a chromosome
+        """
+        return self.data[chromosome]
 
     @property
     def chromosomes(self):
-        self.__reset_handle()
-        chrs = []
-        for x in self.__handle:
-            if "Chromosome" not in x:
-                chrs.append(x.split("\t")[0])
-        return list(set(chrs))
+        return list(self.data.keys())
 
 
-
-def get_cn_lines(lines, cn_type="diploid" ,ploidy=2):
-    """
-    For a list if lines, return those lines belonging to a certain cn_typle
-    :param lines: list of lines
-    :param cn_type: either "normal" (cn= ploidy), "loss" (cn < ploidy) or "gain" (cn > ploidy)
-    :return: list of lines
-    """
-    n_lines = []
-    for line in lines:
-        cn = line.strip().split("\t")[-1]
-        if cn_type == "normal" and int(cn) == ploidy:
-            n_lines.append(line)
-        elif cn_type == "loss" and int(cn) < ploidy:
-            n_lines.append(line)
-        elif cn_type == "gain" and int(cn) > ploidy:
-            n_lines.append(line)
-    return n_lines
-
-
-def lines_to_array(lines, ploidy=2):
+def cn_masks(cn, ploidy=2):
     """
-    Convert list of lines to numpy array of [start, ratio]
+    Classify copy numbers into normal (cn == ploidy), loss (cn < ploidy)
+    and gain (cn > ploidy)
+    :param cn: array of copy numbers
+    :return: tuple of boolean masks (normal, loss, gain)
     """
-    tmp = []
-    for x in lines:
-        start = x.split("\t")[1]
-        ratio = x.split("\t")[2]
-        tmp.append([int(start), float(ratio)*ploidy])
-    return np.array(tmp)
+    return cn == ploidy, cn < ploidy, cn > ploidy
 
 
-def plot_chromosome(lines, chromosome, output_file, ploidy):
+def density_image(starts, values, classes, xlim, ylim, shape):
+    """
+    Rasterize points into an RGBA image of shape (height, width).
+    A pixel gets the colour of the last class in `classes` with at least
+    one point in it, the same stacking order as consecutive scatter calls.
+    :param classes: list of (mask, color) tuples
+    """
+    colors = biopet_runtime.lazy_import("matplotlib.colors")
+    width, height = shape
+    image = np.zeros((height, width, 4))
+    for mask, color in classes:
+        if not mask.any():
+            continue
+        counts, _, _ = np.histogram2d(values[mask], starts[mask],
+                                      bins=(height, width), range=(ylim, xlim))
+        image[counts > 0] = colors.to_rgba(color)
+    return image
+
+
+def plot_chromosome(data, chromosome, output_file, ploidy,
+                    render="auto", density_threshold=DENSITY_THRESHOLD):
     """
-    Plot lines belonging to a chromosome
+    Plot (start, ratio, cn) arrays belonging to a chromosome
     green = where CN = ploidy
     red = where CN > ploidy
     blue = where CN < ploidy
+
+    With render "density", or "auto" and more than density_threshold
+    points, points are binned into a raster the size of the axes instead
+    of being drawn as individual markers.
     """
+    starts, ratios, cn = data
+    values = ratios * ploidy
+    normal, loss, gain = cn_masks(cn, ploidy)
+    classes = ((normal, "g"), (loss, "b"), (gain, "r"))
+
+    plt = biopet_runtime.pyplot()
     fig = plt.figure(figsize=(8,6))
     ax = fig.add_subplot(111)
-    normals = lines_to_array(get_cn_lines(lines, "normal", ploidy), ploidy)
-    losses = lines_to_array(get_cn_lines(lines, "loss", ploidy), ploidy)
-    gains = lines_to_array(get_cn_lines(lines, "gain", ploidy), ploidy)
     print("Plotting chromosome {0}".format(chromosome))
-    all_x = []
-
-    if len(normals) > 0:
-        ax.scatter(normals[:, 0], normals[:,1], color="g")
-        for x in normals[:, 0]:
-            all_x += [x]
-    if len(losses) > 0:
-        ax.scatter(losses[:, 0], losses[:,1], color="b")
-        for x in losses[:, 0]:
-            all_x += [x]
-    if len(gains) > 0:
-        for x in gains[:, 0]:
-            all_x += [x]
-        ax.scatter(gains[:,0], gains[:,1], color="r")
-
-    ax.set_ylim(0, ploidy*3)
-    ax.set_xlim(int(0-(max(all_x)*0.1)), int(max(all_x)+(max(all_x)*0.1)))
+
+    max_x = starts[normal | loss | gain].max()
+    xlim = (int(0-(max_x*0.1)), int(max_x+(max_x*0.1)))
+    ylim = (0, ploidy*3)
+
+    dense = render == "density" or \
+        (render == "auto" and len(starts) > density_threshold)
+    if dense:
+        # one bin per DENSITY_PIXELS x DENSITY_PIXELS screen pixels,
+        # roughly the footprint of a scatter marker
+        extent = ax.get_window_extent()
+        shape = (max(1, int(extent.width) // DENSITY_PIXELS),
+                 max(1, int(extent.height) // DENSITY_PIXELS))
+        image = density_image(starts, values, classes, xlim, ylim, shape)
+        ax.imshow(image, extent=xlim + ylim, origin="lower", aspect="auto",
+                  interpolation="nearest")
+    else:
+        for mask, color in classes:
+            if mask.any():
+                ax.scatter(starts[mask], values[mask], color=color)
+
+    ax.set_ylim(*ylim)
+    ax.set_xlim(*xlim)
 
     ax.set_xlabel("chromosome position")
     ax.set_ylabel("CN")
@@ -125,17 +163,57 @@ def plot_chromosome(lines, chromosome, output_file, ploidy):
     plt.close()
 
 
+def plot_job(job):
+    """
+    Pool worker; job is a tuple of the plot_chromosome arguments
+    """
+    plot_chromosome(*job)
+
+
+def plot_all(jobs, threads=1):
+    """
+    Plot all chromosome jobs, using a pool of worker processes when
+    more than one thread is given. Each worker only receives the arrays of
+    the chromosome it plots.
+    """
+    if threads <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            plot_job(job)
+        return
+    pool = multiprocessing.Pool(min(threads, len(jobs)))
+    try:
+        pool.map(plot_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('-I', "--input", required=True, help="Input bam_ratio.txt file")
+    parser.add_argument('-I', "--input", required=True, help="Input bam_ratio.txt file, optionally gzip / BGZF compressed")
     parser.add_argument('-O', '--output-prefix', required=True, help="Path to output prefix")
     parser.add_argument("-p", "--ploidy", type=int, default=2, help="Ploidy of sample")
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="Number of chromosomes to plot in parallel")
+    parser.add_argument("--render", choices=["auto", "scatter", "density"],
+                        default="auto",
+                        help="Draw every window as a marker (scatter), bin "
+                             "windows into a raster (density), or pick "
+                             "density above --density-threshold windows (auto)")
+    parser.add_argument("--density-threshold", type=int,
+                        default=DENSITY_THRESHOLD,
+                        help="Number of windows per chromosome above which "
+                             "auto rendering uses a raster")
 
     args = parser.parse_args()
+    biopet_runtime.init(__file__)
 
     reader = BamRatioReader(args.input)
+    jobs = []
     for chromosome in reader.chromosomes:
         ofile = args.output_prefix + "." + "chr{0}.png".format(chromosome)
-        lines = reader.get_chromosome(chromosome)
-        plot_chromosome(lines, chromosome, ofile, args.ploidy)
\ No newline at end of file
+        data = reader.get_chromosome(chromosome)
+        jobs.append((data, chromosome, ofile, args.ploidy,
+                     args.render, args.density_threshold))
+        biopet_runtime.add_records(len(data[0]))
+    plot_all(jobs, args.threads)
@@ -22,12 +22,21 @@ __author__="Peter van 't Hof"
 import sys
 import re
 
+import biopet_io
+import biopet_runtime
+
 upacPatern = re.compile(r'[RYKMSWBDHV]')
 
 if __name__ == "__main__":
-    for line in sys.stdin:
+    biopet_runtime.init(__file__)
+    instream = biopet_io.open_input("-")
+    outstream = biopet_io.open_output("-")
+    records = 0
+    for records, line in enumerate(instream, 1):
         l = line.strip().split("\t")
         if len(l) >= 3:
             l[3] = upacPatern.sub("N", l[3])
 
-        print("\t".join(map(str, l)))
+        print("\t".join(map(str, l)), file=outstream)
+    outstream.close()
+    biopet_runtime.add_records(records)
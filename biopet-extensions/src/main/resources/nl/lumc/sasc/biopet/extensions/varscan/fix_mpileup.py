@@ -22,6 +22,9 @@ __author__="Wai Yi Leung"
 import sys
 import re
 
+import biopet_io
+import biopet_runtime
+
 upacPatern = re.compile(r'[RYKMSWBDHV]')
 
 if __name__ == "__main__":
@@ -30,13 +33,17 @@ if __name__ == "__main__":
         Solution offered by Irina Pulyakhina (LUMC-HG)
         http://www.biostars.org/p/78542/
     """
-    for line in sys.stdin:
+    biopet_runtime.init(__file__)
+    instream = biopet_io.open_input("-")
+    outstream = biopet_io.open_output("-")
+    records = 0
+    for records, line in enumerate(instream, 1):
         l = line.strip().split("\t")
         l[2] = upacPatern.sub("N", l[2])
 
         if len(l) < 4 or l[3] == "0":
             # no alignment to this position
-            print("\t".join(map(str, l)))
+            print("\t".join(map(str, l)), file=outstream)
             continue
 
         fix_col = l[4].replace('<', '').replace('>', '')
@@ -50,4 +57,6 @@ if __name__ == "__main__":
         if new_size == 0:
             l[5] = ""
 
-        print("\t".join(map(str, l)))
+        print("\t".join(map(str, l)), file=outstream)
+    outstream.close()
+    biopet_runtime.add_records(records)
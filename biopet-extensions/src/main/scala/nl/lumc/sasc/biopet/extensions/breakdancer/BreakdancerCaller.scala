@@ -93,8 +93,7 @@ class BreakdancerCaller(val parent: Configurable) extends BiopetCommandLineFunct
       conditional(h, "-h") +
       optional("-y", y) +
       required(input) +
-      ">" +
-      required(output)
+      (if (outputAsStdout) "" else ">" + required(output))
 }
 
 object BreakdancerCaller {
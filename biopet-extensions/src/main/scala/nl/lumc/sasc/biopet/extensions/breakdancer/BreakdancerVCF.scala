@@ -16,14 +16,15 @@ package nl.lumc.sasc.biopet.extensions.breakdancer
 
 import java.io.File
 
+import nl.lumc.sasc.biopet.core.Reference
 import nl.lumc.sasc.biopet.core.extensions.PythonCommandLineFunction
 import nl.lumc.sasc.biopet.utils.config.Configurable
 import org.broadinstitute.gatk.utils.commandline._
 
-class BreakdancerVCF(val parent: Configurable) extends PythonCommandLineFunction {
+class BreakdancerVCF(val parent: Configurable) extends PythonCommandLineFunction with Reference {
   setPythonScript("breakdancer2vcf.py")
 
-  @Input(doc = "Breakdancer TSV")
+  @Input(doc = "Breakdancer TSV", required = false)
   var input: File = _
 
   @Output(doc = "Output VCF to PATH")
@@ -32,11 +33,31 @@ class BreakdancerVCF(val parent: Configurable) extends PythonCommandLineFunction
   @Argument(doc = "Samplename")
   var sample: String = _
 
+  @Input(doc = "Reference fasta, used for the REF bases", required = false)
+  var reference: Option[File] = None
+
+  /** When true REF bases are taken from the reference, otherwise REF is written as N */
+  var refBases: Boolean = config("ref_bases", default = false)
+
+  override def faiRequired: Boolean = refBases
+
+  /** Calls with a lower score or read support are skipped */
+  var minScore: Option[Int] = config("min_score")
+  var minReads: Option[Int] = config("min_reads")
+
+  override def beforeGraph(): Unit = {
+    super.beforeGraph()
+    if (refBases && reference.isEmpty) reference = Some(referenceFasta())
+  }
+
   def cmdLine: String = {
     getPythonCommand +
-      "-i " + required(input) +
+      "-i " + (if (inputAsStdin) " - " else required(input)) +
       "-o " + required(output) +
-      "-s " + required(sample)
+      "-s " + required(sample) +
+      optional("-r", reference) +
+      optional("--min-score", minScore) +
+      optional("--min-reads", minReads)
   }
 }
 
@@ -29,8 +29,18 @@ class FreeCCNVPlot(val parent: Configurable) extends PythonCommandLineFunction {
   @Output(doc = "Destination for the PNG file", required = true)
   var output: File = _
 
+  /** One of "auto", "scatter" or "density" */
+  var render: Option[String] = config("render")
+  var densityThreshold: Option[Int] = config("density_threshold")
+
+  /** Chromosomes are plotted in parallel, one worker process per core */
+  override def defaultThreads = 1
+
   override def cmdLine: String =
     getPythonCommand +
       required("-I", input) +
-      required("-O", output)
+      required("-O", output) +
+      required("-t", threads) +
+      optional("--render", render) +
+      optional("--density-threshold", densityThreshold)
 }
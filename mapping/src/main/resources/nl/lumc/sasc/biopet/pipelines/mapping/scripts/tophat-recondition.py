@@ -26,6 +26,8 @@ from __future__ import print_function
 import errno
 import os
 import sys
+
+import biopet_runtime
 try:
     import pysam
 except ImportError:
@@ -34,6 +36,14 @@ except ImportError:
 
 VERSION = "0.3"
 
+MASK64 = 2 ** 64 - 1
+MASK32 = 2 ** 32 - 1
+# number of reads converted to arrays at once
+CHUNK_SIZE = 1 << 16
+
+# numpy, imported when the compact index is used
+np = None
+
 
 def get_index_pos(index, read):
     """Returns the position of a read in the index or None."""
@@ -44,8 +54,202 @@ def get_index_pos(index, read):
         return None
 
 
+def strip_qname(qname):
+    """Returns the read name without its /1 or /2 suffix."""
+    if qname.find("/") != -1:
+        return qname[:-2]
+    return qname
+
+
+def qname_hash(qname):
+    """
+    Returns the (64-bit, 32-bit) hash pair of a read name. The second hash
+    is taken over the reversed name; it only serves to detect collisions of
+    the first one. Both are only valid within one process.
+    """
+    return hash(qname) & MASK64, hash(qname[::-1]) & MASK32
+
+
+def _load_numpy():
+    """Imports numpy for the compact index; returns False when it is missing."""
+    global np
+    if np is None:
+        try:
+            np = biopet_runtime.lazy_import("numpy")
+        except ImportError:
+            return False
+    return True
+
+
+class CollisionError(Exception):
+    """Two different read names in the unmapped file share a hash."""
+
+
+class QnameIndex(object):
+    """
+    Compact index of the read names of the unmapped file.
+
+    Instead of a dict of read names, the index holds one sorted array of
+    64-bit name hashes, resolved with a binary search, and for every name
+    the position of its last read and its number of reads. Only the fields
+    patched from the mapped file (tid and pos) are stored per name.
+    """
+
+    def __init__(self, hashes, checks):
+        order = np.argsort(hashes, kind="mergesort")
+        sorted_hashes = hashes[order]
+        sorted_checks = checks[order]
+        same = sorted_hashes[1:] == sorted_hashes[:-1]
+        if (sorted_checks[1:][same] != sorted_checks[:-1][same]).any():
+            raise CollisionError("read name hash collision")
+        first = np.ones(len(hashes), dtype=bool)
+        first[1:] = ~same
+        starts = np.flatnonzero(first)
+        self.hashes = sorted_hashes[starts]
+        self.checks = sorted_checks[starts]
+        self.counts = np.diff(np.append(starts, len(hashes)))
+        # the stable sort keeps the reads of a name in file order
+        self.last = order[starts + self.counts - 1]
+        # name of every read, to look up its fields in the second pass
+        names = np.cumsum(first) - 1
+        self.read_names = np.empty_like(names)
+        self.read_names[order] = names
+        self.tid = np.full(len(starts), -2, dtype=np.int32)
+        self.pos = np.zeros(len(starts), dtype=np.int64)
+
+    def lookup(self, hashes, checks):
+        """Returns the name indices of the hashes, -1 where a name is absent."""
+        if len(self.hashes) == 0:
+            return np.full(len(hashes), -1, dtype=np.int64)
+        names = np.searchsorted(self.hashes, hashes)
+        names[names == len(self.hashes)] = 0
+        found = (self.hashes[names] == hashes) & (self.checks[names] == checks)
+        return np.where(found, names, -1)
+
+    def patch(self, rows, tid_map):
+        """
+        Stores tid and pos of (hash, check, tid, pos) rows of mapped reads,
+        the tid translated with tid_map; the last read of a name wins.
+        """
+        rows = np.array(rows, dtype=np.uint64).reshape(-1, 4)
+        names = self.lookup(rows[:, 0], rows[:, 1])
+        keep = np.flatnonzero(names >= 0)
+        # keep the last occurrence of every name
+        keep = keep[len(keep) - 1 - np.unique(names[keep][::-1], return_index=True)[1]]
+        self.tid[names[keep]] = tid_map[rows[keep, 2].astype(np.int64)]
+        self.pos[names[keep]] = rows[keep, 3].astype(np.int64)
+
+    def fixes(self):
+        """
+        Returns a boolean array with the reads whose mate flag is set, and
+        (read, tid, pos) arrays of the reads to patch, in file order.
+        """
+        mates = self.counts[self.read_names] > 1
+        fixed = np.flatnonzero(self.tid != -2)
+        reads = self.last[fixed]
+        order = np.argsort(reads)
+        return mates, reads[order], self.tid[fixed][order], self.pos[fixed][order]
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    """Splits an iterator of tuples into lists of at most size items."""
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _fixup_header(header, cmdline):
+    fixup_header = header
+    fixup_header['PG'].append({'ID': 'TopHat-Recondition',
+                               'VN': VERSION,
+                               'CL': cmdline})
+    return fixup_header
+
+
+def _out_filename(unmapped_file):
+    base, _ = os.path.splitext(unmapped_file)
+    return "".join([base, "_fixup.sam"]) # since BAM bin values may be messed up after processing
+
+
 def fix_unmapped_reads(path, outdir, mapped_file="accepted_hits.bam",
                        unmapped_file="unmapped.bam", cmdline=""):
+    """
+    Write the fixed unmapped reads, using a compact hashed index of the
+    read names and reading the unmapped file twice. Falls back to
+    fix_unmapped_reads_in_memory when numpy is not installed or read name
+    hashes collide.
+    """
+    if not _load_numpy():
+        return fix_unmapped_reads_in_memory(path, outdir, mapped_file,
+                                            unmapped_file, cmdline)
+    unmapped_path = os.path.join(path, unmapped_file)
+    with pysam.Samfile(unmapped_path) as bam_unmapped:
+        chunks = [np.array(chunk, dtype=np.uint64).reshape(-1, 2)
+                  for chunk in _chunks(qname_hash(strip_qname(read.qname))
+                                       for read in bam_unmapped.fetch(until_eof=True))]
+        unmapped_refs = bam_unmapped.references
+    pairs = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype=np.uint64)
+    records = len(pairs)
+    try:
+        index = QnameIndex(pairs[:, 0].copy(), pairs[:, 1].copy())
+    except CollisionError:
+        return fix_unmapped_reads_in_memory(path, outdir, mapped_file,
+                                            unmapped_file, cmdline)
+    del pairs, chunks
+
+    # Fix things that relate only to unmapped reads with a mapped mate.
+    tids = dict((name, i) for i, name in enumerate(unmapped_refs))
+    with pysam.Samfile(os.path.join(path, mapped_file)) as bam_mapped:
+        # map chromosome TIDs from mapped to unmapped file, -1 maps to -1
+        tid_map = np.array([tids.get(name, -1) for name in bam_mapped.references] + [-1],
+                           dtype=np.int32)
+        rows = []
+        for mapped in bam_mapped:
+            records += 1
+            if mapped.mate_is_unmapped:
+                rows.append(qname_hash(mapped.qname) + (mapped.tid & MASK64, mapped.pos))
+                if len(rows) == CHUNK_SIZE:
+                    index.patch(rows, tid_map)
+                    rows = []
+        if rows:
+            index.patch(rows, tid_map)
+
+    mates, reads, new_tids, new_pos = index.fixes()
+    del index
+    fix = 0
+    next_fix = int(reads[0]) if len(reads) else -1
+    with pysam.Samfile(unmapped_path) as bam_unmapped:
+        fixup_header = _fixup_header(bam_unmapped.header, cmdline)
+        with pysam.Samfile(os.path.join(outdir, _out_filename(unmapped_file)), "wh",
+                           header=fixup_header) as bam_out:
+            for i, read in enumerate(bam_unmapped.fetch(until_eof=True)):
+                read.qname = strip_qname(read.qname)
+                # work around "mate is unmapped" bug in TopHat
+                if mates[i]:
+                    read.mate_is_unmapped = True
+                read.mapq = 0
+                if i == next_fix:
+                    read.tid = int(new_tids[fix])
+                    read.rnext = int(new_tids[fix])
+                    read.pos = int(new_pos[fix])
+                    read.pnext = 0
+                    fix += 1
+                    next_fix = int(reads[fix]) if fix < len(reads) else -1
+                bam_out.write(read)
+    return records
+
+
+def fix_unmapped_reads_in_memory(path, outdir, mapped_file="accepted_hits.bam",
+                                 unmapped_file="unmapped.bam", cmdline=""):
+    """
+    Write the fixed unmapped reads, keeping all of them in memory with a
+    dict of their names.
+    """
     # Fix things that relate to all unmapped reads.
     unmapped_dict = {}
     unmapped_index = {}
@@ -73,8 +277,10 @@ def fix_unmapped_reads(path, outdir, mapped_file="accepted_hits.bam",
             unmapped_reads[i] = read
 
         # Fix things that relate only to unmapped reads with a mapped mate.
+        records = len(unmapped_reads)
         with pysam.Samfile(os.path.join(path, mapped_file)) as bam_mapped:
             for mapped in bam_mapped:
+                records += 1
                 if mapped.mate_is_unmapped:
                     i = get_index_pos(unmapped_index, mapped)
                     if i is not None:
@@ -91,25 +297,129 @@ def fix_unmapped_reads(path, outdir, mapped_file="accepted_hits.bam",
 
                         unmapped_reads[i] = unmapped
 
-        # for the output file, take the headers from the unmapped file
-        base, _ = os.path.splitext(unmapped_file)
-        out_filename = "".join([base, "_fixup.sam"]) # since BAM bin values may be messed up after processing
-
-    fixup_header = unmapped_header
-    fixup_header['PG'].append({'ID': 'TopHat-Recondition',
-                               'VN': VERSION,
-                               'CL': cmdline})
-    with pysam.Samfile(os.path.join(outdir, out_filename), "wh",
+    # for the output file, take the headers from the unmapped file
+    fixup_header = _fixup_header(unmapped_header, cmdline)
+    with pysam.Samfile(os.path.join(outdir, _out_filename(unmapped_file)), "wh",
                        header=fixup_header) as bam_out:
         for read in unmapped_reads:
             bam_out.write(read)
+    return records
+
+
+def recondition(bamdir, resultdir=None, cmdline="", debug=False):
+    """
+    Run fix_unmapped_reads on one TopHat output directory.
+
+    Returns (exit status, error report, number of reads processed); the
+    report is empty on success.
+    """
+    if resultdir is None:
+        resultdir = bamdir
+    if not os.path.isdir(bamdir):
+        return (errno.EINVAL, "Specified tophat_output_dir does not exist or "
+                              "is not a directory: %s" % bamdir, 0)
+    if not os.path.isdir(resultdir):
+        return (errno.EINVAL, "Specified result_dir does not exist or "
+                              "is not a directory: %s" % resultdir, 0)
+    try:
+        records = fix_unmapped_reads(bamdir, resultdir, cmdline=cmdline)
+    except Exception as e:
+        report = "Error: %s" % str(e)
+        if debug:
+            import traceback
+            report = traceback.format_exc() + report
+        return (getattr(e, "errno", None) or 1, report, 0)
+    return (0, "", records)
+
+
+def _recondition_job(job):
+    bamdir, resultdir, cmdline, debug = job
+    return (bamdir, resultdir) + recondition(bamdir, resultdir, cmdline, debug)
+
+
+def read_batch(path):
+    """
+    Read a batch file: one TopHat output directory per line, optionally
+    followed by its result directory. Empty lines and lines starting with
+    '#' are skipped; '-' reads from stdin. Every result directory may be
+    used only once, as the jobs would overwrite each other's output.
+    """
+    handle = sys.stdin if path == "-" else open(path)
+    try:
+        jobs = []
+        seen = {}
+        for line in handle:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) > 2:
+                raise ValueError("Expected tophat_output_dir [result_dir], got: %s"
+                                 % line.strip())
+            resultdir = fields[1] if len(fields) > 1 else fields[0]
+            key = os.path.realpath(resultdir)
+            if key in seen:
+                raise ValueError("Result directory %s is used by both %s and %s"
+                                 % (resultdir, seen[key], fields[0]))
+            seen[key] = fields[0]
+            jobs.append((fields[0], resultdir))
+        return jobs
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def recondition_batch(jobs, processes, cmdline="", debug=False):
+    """
+    Process (tophat_output_dir, result_dir) pairs in a pool of at most
+    `processes` worker processes.
+
+    For every directory an error report is printed to stderr when it fails,
+    and a status line (exit status, tophat_output_dir, result_dir) to stdout
+    in input order. Returns the exit status of the first failed directory,
+    or 0 when all succeeded.
+    """
+    import multiprocessing
+    tasks = [(bamdir, resultdir, cmdline, debug) for bamdir, resultdir in jobs]
+    processes = max(1, min(processes, len(tasks)))
+    if processes == 1:
+        results = map(_recondition_job, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_recondition_job, tasks)
+    status = 0
+    try:
+        for bamdir, resultdir, code, report, records in results:
+            biopet_runtime.add_records(records)
+            if code != 0:
+                print("[%s] %s" % (bamdir, report.rstrip("\n").replace(
+                    "\n", "\n[%s] " % bamdir)), file=sys.stderr)
+                if status == 0:
+                    status = code
+            print("%d\t%s\t%s" % (code, bamdir, resultdir))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return status
 
 
 def usage(scriptname, errcode=errno.EINVAL):
     print("Usage:\n")
-    print(scriptname, "[-hv] tophat_output_dir [result_dir]\n")
+    print(scriptname, "[-hv] tophat_output_dir [result_dir]")
+    print(scriptname, "[-hv] [-p processes] -b batch_file\n")
     print("-h                 print this usage text and exit")
     print("-v                 print the script name and version, and exit")
+    print("-b batch_file:     file with one 'tophat_output_dir [result_dir]' per line ('-' for stdin);")
+    print("                   directories are processed concurrently, each with its own")
+    print("                   error report, and a line 'status<TAB>tophat_output_dir<TAB>result_dir'")
+    print("                   is written to stdout for every directory")
+    print("-p processes:      maximum number of directories processed at the same time in batch")
+    print("                   mode (default: number of CPUs)")
     print("tophat_output_dir: directory containing accepted_hits.bam and unmapped.bam")
     print("result_dir:        directory to write unmapped_fixup.bam to (default: tophat_output_dir)")
     sys.exit(errcode)
@@ -118,22 +428,33 @@ def usage(scriptname, errcode=errno.EINVAL):
 if __name__ == "__main__":
     import getopt
 
+    biopet_runtime.init(__file__)
     scriptname = os.path.basename(sys.argv[0])
     cmdline = " ".join(sys.argv)
 
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], "dhv")
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "b:dhp:v")
     except getopt.GetoptError as err:
         # print help information and exit
         print(str(err), file=sys.stderr)
         usage(scriptname, errcode=errno.EINVAL)
 
     debug = False
+    batch = None
+    processes = None
     for o, a in opts:
-        if o in "-d":
+        if o in "-b":
+            batch = a
+        elif o in "-d":
             debug = True
         elif o in "-h":
             usage(scriptname, errcode=0)
+        elif o in "-p":
+            try:
+                processes = int(a)
+            except ValueError:
+                print("Invalid number of processes: %s" % a, file=sys.stderr)
+                sys.exit(errno.EINVAL)
         elif o in "-v":
             print(scriptname, VERSION)
             sys.exit(0)
@@ -141,34 +462,36 @@ if __name__ == "__main__":
             assert False, "unhandled option"
             sys.exit(errno.EINVAL)
 
+    if batch is not None:
+        if args:
+            usage(scriptname, errcode=errno.EINVAL)
+        try:
+            jobs = read_batch(batch)
+        except (IOError, ValueError) as e:
+            print("Cannot read batch file %s: %s" % (batch, e), file=sys.stderr)
+            sys.exit(errno.EINVAL)
+        if processes is None:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+        try:
+            sys.exit(recondition_batch(jobs, processes, cmdline=cmdline, debug=debug))
+        except KeyboardInterrupt:
+            print("Program interrupted by user, exiting.")
+            sys.exit(errno.EINTR)
+
     if len(args) == 0 or len(args) > 2:
         usage(scriptname, errcode=errno.EINVAL)
 
     bamdir = args.pop(0)
-    if not os.path.isdir(bamdir):
-        print("Specified tophat_output_dir does not exist or is not a directory: %s" % bamdir, file=sys.stderr)
-        sys.exit(errno.EINVAL)
-
-    if len(args) > 0:
-        resultdir = args.pop(0)
-        if not os.path.isdir(resultdir):
-            print("Specified result_dir does not exist or is not a directory: %s" % resultdir, file=sys.stderr)
-            sys.exit(errno.EINVAL)
-    else:
-        resultdir = bamdir
+    resultdir = args.pop(0) if args else bamdir
 
     try:
-        fix_unmapped_reads(bamdir, resultdir, cmdline=cmdline)
+        code, report, records = recondition(bamdir, resultdir, cmdline=cmdline,
+                                            debug=debug)
+        biopet_runtime.add_records(records)
     except KeyboardInterrupt:
         print("Program interrupted by user, exiting.")
         sys.exit(errno.EINTR)
-    except Exception as e:
-        if debug:
-            import traceback
-            print(traceback.format_exc(), file=sys.stderr)
-
-        print("Error: %s" % str(e), file=sys.stderr)
-        if hasattr(e, "errno"):
-            sys.exit(e.errno)
-        else:
-            sys.exit(1)
+    if code != 0:
+        print(report, file=sys.stderr)
+    sys.exit(code)
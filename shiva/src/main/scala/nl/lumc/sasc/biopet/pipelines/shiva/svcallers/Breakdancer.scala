@@ -26,6 +26,9 @@ import nl.lumc.sasc.biopet.utils.config.Configurable
 class Breakdancer(val parent: Configurable) extends SvCaller {
   def name = "breakdancer"
 
+  /** When false, the breakdancer output is piped into the vcf conversion without writing the tsv */
+  val keepTsv: Boolean = config("keep_tsv", default = true)
+
   def biopetScript() {
     for ((sample, bamFile) <- inputBams) {
       val breakdancerSampleDir = new File(outputDir, sample)
@@ -36,21 +39,24 @@ class Breakdancer(val parent: Configurable) extends SvCaller {
       val bdcfg = BreakdancerConfig(this,
                                     bamFile,
                                     new File(breakdancerSampleDir, sample + ".breakdancer.cfg"))
-      val breakdancer = BreakdancerCaller(
-        this,
-        bdcfg.output,
-        new File(breakdancerSampleDir, sample + ".breakdancer.tsv"))
+      val breakdancer = new BreakdancerCaller(this)
+      breakdancer.input = bdcfg.output
       breakdancer.deps :+= bamFile
-      val bdvcf = BreakdancerVCF(this,
-                                 breakdancer.output,
-                                 new File(breakdancerSampleDir, sample + ".breakdancer.vcf"),
-                                 sample = sample + sampleNameSuffix)
+      val bdvcf = new BreakdancerVCF(this)
+      bdvcf.output = new File(breakdancerSampleDir, sample + ".breakdancer.vcf")
+      bdvcf.sample = sample + sampleNameSuffix
 
       val compressedVCF = new SortVcf(this)
       compressedVCF.input = bdvcf.output
       compressedVCF.output = new File(breakdancerSampleDir, s"$sample.breakdancer.vcf.gz")
 
-      add(bdcfg, breakdancer, bdvcf, compressedVCF)
+      add(bdcfg)
+      if (keepTsv) {
+        breakdancer.output = new File(breakdancerSampleDir, sample + ".breakdancer.tsv")
+        bdvcf.input = breakdancer.output
+        add(breakdancer, bdvcf)
+      } else add(breakdancer | bdvcf)
+      add(compressedVCF)
 
       addVCF(sample, compressedVCF.output)
     }
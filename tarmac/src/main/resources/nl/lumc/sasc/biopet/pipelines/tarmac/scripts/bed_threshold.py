@@ -18,20 +18,25 @@
 import argparse
 import numpy as np
 
+import biopet_io
+import biopet_runtime
+
 
 class Thresholder(object):
-    def __init__(self, filename, threshold):
-        self.__handle = open(filename)
+    def __init__(self, filename, threshold, output):
+        self.__handle = biopet_io.open_input(filename)
+        self.output = output
         self.threshold = threshold
         self.chrom = None
         self.start = None
         self.end = None
         self.vals = []
+        self.records = 0
 
     def flush(self):
         if all([x is not None for x in [self.chrom, self.start, self.end]]):
             v = np.median(self.vals)
-            print("{0}\t{1}\t{2}\t{3}".format(
+            self.output.write("{0}\t{1}\t{2}\t{3}\n".format(
                 self.chrom, self.start, self.end, v
             ))
         self.chrom = None
@@ -44,6 +49,7 @@ class Thresholder(object):
 
     def __next__(self):
         line = next(self.__handle)
+        self.records += 1
         chrom, start, end, value = line.strip().split("\t")
         if abs(float(value)) >= self.threshold:
             if chrom != self.chrom:
@@ -66,13 +72,57 @@ class Thresholder(object):
         self.__handle.close()
 
 
+def threshold_grid(values, grid, threshold, output):
+    """
+    Vectorized Thresholder for region-grid values: writes the same runs of
+    consecutive present regions with |value| >= threshold, split on contig
+    changes, with the median value of each run.
+    """
+    import biopet_grid
+    present = np.flatnonzero(values.present)
+    biopet_runtime.add_records(len(present))
+    vals = values.values[present]
+    contigs = grid.contig_ids[present]
+    passing = np.abs(vals) >= threshold
+    first = passing.copy()
+    first[1:] &= ~passing[:-1] | (contigs[1:] != contigs[:-1])
+    last = passing.copy()
+    last[:-1] &= ~passing[1:] | (contigs[1:] != contigs[:-1])
+    run_starts, run_ends = np.flatnonzero(first), np.flatnonzero(last)
+    for a, b in zip(run_starts.tolist(), run_ends.tolist()):
+        output.write("{0}\t{1}\t{2}\t{3}\n".format(
+            grid.contigs[contigs[a]], grid.starts[present[a]],
+            grid.ends[present[b]],
+            biopet_grid.format_value(np.median(vals[a:b + 1]))))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', "--input", required=True)
     parser.add_argument("-t", "--threshold", type=int, default=5)
+    parser.add_argument("-o", "--output", default="-",
+                        help="Output bed file, BGZF compressed when ending in "
+                             ".gz (default: stdout)")
+    parser.add_argument("--bgzf", action="store_true",
+                        help="Always write BGZF compressed output")
+    parser.add_argument("--grid",
+                        help="Region table of a region-grid values input")
 
     args = parser.parse_args()
-    t = Thresholder(args.input, args.threshold)
-    for _ in t:
-        pass
-    t.flush()
\ No newline at end of file
+    biopet_runtime.init(__file__)
+    output = biopet_io.open_output(args.output, bgzf=args.bgzf or None)
+    if biopet_io.is_grid_file(args.input):
+        import biopet_grid
+        if args.grid is None:
+            parser.error("a region-grid input requires --grid")
+        grid = biopet_grid.RegionGrid.read(args.grid)
+        threshold_grid(biopet_grid.load_values(args.input, grid), grid,
+                       args.threshold, output)
+    else:
+        t = Thresholder(args.input, args.threshold, output)
+        for _ in t:
+            pass
+        t.flush()
+        t.close()
+        biopet_runtime.add_records(t.records)
+    output.close()
@@ -17,25 +17,242 @@
 #
 
 import argparse
+import bisect
+import os
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input")
-    parser.add_argument("--db", action="append", default=[])
+import biopet_io
+import biopet_runtime
 
-    args = parser.parse_args()
 
+def find_all_common_bed(args):
     dbs = []
     for x in args.db:
         d = {}
-        with open(x) as db_handle:
+        with biopet_io.open_input(x) as db_handle:
             for line in db_handle:
                 reg = "\t".join(line.split("\t")[:3])
                 d[reg] = True
             dbs.append(d)
 
-    with open(args.input) as inhandle:
-        for line in inhandle:
+    with biopet_io.open_input(args.input) as inhandle, \
+            biopet_io.open_output(args.output, bgzf=args.bgzf or None) as outhandle:
+        records = 0
+        for records, line in enumerate(inhandle, 1):
             reg = "\t".join(line.split("\t")[:3])
             if all([reg in x for x in dbs]):
-                print(line.strip())
+                outhandle.write(line.strip() + "\n")
+        biopet_runtime.add_records(records)
+
+
+def is_header(line):
+    return not line.strip() or line.startswith(("#", "track", "browser"))
+
+
+def parse_region(line):
+    fields = line.split("\t", 3)
+    return fields[0], int(fields[1]), int(fields[2])
+
+
+class IntervalIndex(object):
+    """
+    Sorted per-contig interval index of the regions of a bed file.
+
+    Per contig the starts and ends are sorted by start, together with the
+    running maximum of the ends, so the regions overlapping a query are
+    found with two binary searches. Optionally the record (the line) of
+    every region is kept as well.
+    """
+
+    def __init__(self, regions):
+        contigs = {}
+        for chrom, start, end, record in regions:
+            contigs.setdefault(chrom, []).append((start, end, record))
+        self.contigs = {}
+        for chrom, intervals in contigs.items():
+            intervals.sort(key=lambda x: x[:2])
+            starts = [x[0] for x in intervals]
+            ends = [x[1] for x in intervals]
+            records = [x[2] for x in intervals]
+            max_ends = []
+            max_end = None
+            for end in ends:
+                max_end = end if max_end is None else max(max_end, end)
+                max_ends.append(max_end)
+            self.contigs[chrom] = (starts, ends, max_ends, records)
+
+    @classmethod
+    def read(cls, path, keep_records=False):
+        with biopet_io.open_input(path) as handle:
+            return cls(parse_region(line) + (line.strip() if keep_records else None,)
+                       for line in handle if not is_header(line))
+
+    def overlapping_records(self, chrom, start, end):
+        """Yields (start, end, record) of the regions overlapping [start, end)."""
+        contig = self.contigs.get(chrom)
+        if contig is None:
+            return
+        starts, ends, max_ends, records = contig
+        # regions before lo end at or before start, regions from hi start at or after end
+        lo = bisect.bisect_right(max_ends, start)
+        hi = bisect.bisect_left(starts, end)
+        for i in range(lo, hi):
+            if ends[i] > start:
+                yield starts[i], ends[i], records[i]
+
+    def overlapping(self, chrom, start, end):
+        """Yields (start, end) of the regions overlapping [start, end)."""
+        for s, e, _ in self.overlapping_records(chrom, start, end):
+            yield s, e
+
+
+def common_intersections(indexes, chrom, start, end, min_overlap):
+    """
+    Parts of [start, end) that overlap a region of every index, one per
+    combination of overlapping regions. Each region has to overlap the
+    whole of [start, end) by at least min_overlap bases, not only the part
+    left by the previous indexes.
+    """
+    parts = [(start, end)]
+    for index in indexes:
+        parts = [(max(s, part_start), min(e, part_end))
+                 for part_start, part_end in parts
+                 for s, e in index.overlapping(chrom, part_start, part_end)
+                 if min(e, end) - max(s, start) >= min_overlap]
+        if not parts:
+            break
+    return parts
+
+
+def find_all_common_overlap(args):
+    """
+    Overlap version: a region is common when it overlaps a region of every
+    db, by at least --min-overlap of its length. Writes either the input
+    records, or like `bedtools intersect` the overlapping part of them.
+    With --pair-output, the db record of every part is written there with
+    the same coordinates, so both outputs hold the same regions in the
+    same order.
+    """
+    pair = args.pair_output is not None
+    indexes = [IntervalIndex.read(x, keep_records=pair) for x in args.db]
+    with biopet_io.open_input(args.input) as inhandle, \
+            biopet_io.open_output(args.output, bgzf=args.bgzf or None) as outhandle, \
+            (biopet_io.open_output(args.pair_output, bgzf=args.bgzf or None) if pair
+             else open(os.devnull, "w")) as pairhandle:
+        records = 0
+        for line in inhandle:
+            if is_header(line):
+                continue
+            records += 1
+            fields = line.strip().split("\t")
+            chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            min_overlap = (args.min_overlap or 0) * (end - start)
+            if args.report == "input":
+                if all(any(min(e, end) - max(s, start) >= min_overlap
+                           for s, e in index.overlapping(chrom, start, end))
+                       for index in indexes):
+                    outhandle.write(line.strip() + "\n")
+            elif pair:
+                for s, e, record in indexes[0].overlapping_records(chrom, start, end):
+                    if min(e, end) - max(s, start) < min_overlap:
+                        continue
+                    part = str(max(s, start)), str(min(e, end))
+                    fields[1:3] = part
+                    outhandle.write("\t".join(fields) + "\n")
+                    db_fields = record.split("\t")
+                    db_fields[1:3] = part
+                    pairhandle.write("\t".join(db_fields) + "\n")
+            else:
+                for part_start, part_end in common_intersections(
+                        indexes, chrom, start, end, min_overlap):
+                    fields[1:3] = str(part_start), str(part_end)
+                    outhandle.write("\t".join(fields) + "\n")
+        biopet_runtime.add_records(records)
+
+
+def fraction(value):
+    value = float(value)
+    if not 0 < value <= 1:
+        raise argparse.ArgumentTypeError("must be in (0, 1]: %s" % value)
+    return value
+
+
+def find_all_common_grid(args):
+    """
+    Region-grid version: the common regions are the AND of the presence
+    bitmaps, the values are those of the input. Bed inputs are mapped on
+    the region table given with --grid.
+    """
+    import biopet_grid
+    grid = biopet_grid.RegionGrid.read(args.grid) if args.grid else None
+    values = biopet_grid.load_values(args.input, grid)
+    present = values.present.copy()
+    biopet_runtime.add_records(int(present.sum()))
+    for db in args.db:
+        db_values = biopet_grid.load_values(db, grid)
+        if db_values.grid_digest != values.grid_digest:
+            raise ValueError("{0} and {1} belong to different region "
+                             "tables".format(args.input, db))
+        present &= db_values.present
+    common = biopet_grid.GridValues(values.grid_digest, values.values, present,
+                                    name=values.name)
+    if args.output_format == "grid":
+        common.write(args.output)
+    elif grid is None:
+        raise ValueError("Writing bed output requires the region table (--grid)")
+    else:
+        with biopet_io.open_output(args.output, bgzf=args.bgzf or None) as outhandle:
+            for line in common.bed_lines(grid):
+                outhandle.write(line + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input")
+    parser.add_argument("--db", action="append", default=[])
+    parser.add_argument("-o", "--output", default="-",
+                        help="Output bed file, BGZF compressed when ending in "
+                             ".gz (default: stdout)")
+    parser.add_argument("--bgzf", action="store_true",
+                        help="Always write BGZF compressed output")
+    parser.add_argument("--grid",
+                        help="Region table; needed to read bed inputs or to "
+                             "write bed output when region-grid files are used")
+    parser.add_argument("--output-format", choices=["bed", "grid"], default="bed",
+                        help="Write a bed file or a region-grid values file "
+                             "(default: %(default)s)")
+    parser.add_argument("--overlap", action="store_true",
+                        help="Regions are common when they overlap instead of "
+                             "having identical coordinates")
+    parser.add_argument("--min-overlap", type=fraction,
+                        help="Minimum overlap with a region of every db, as a "
+                             "fraction of the input region (default: 1 base); "
+                             "implies --overlap")
+    parser.add_argument("--report", choices=["input", "intersection"],
+                        default="input",
+                        help="With --overlap, write the input records or only "
+                             "the parts overlapping every db, one per "
+                             "combination of overlapping regions "
+                             "(default: %(default)s)")
+    parser.add_argument("--pair-output",
+                        help="With --report intersection and a single db, "
+                             "also write the db record of every part, with "
+                             "the coordinates of the part, to this file")
+
+    args = parser.parse_args()
+    biopet_runtime.init(__file__)
+
+    # any region-grid input, or grid output, switches to the region-grid version
+    overlap = args.overlap or args.min_overlap is not None
+    if args.output_format == "grid" or any(
+            biopet_io.is_grid_file(x) for x in [args.input] + args.db):
+        if overlap:
+            parser.error("--overlap does not apply to region-grid files")
+        find_all_common_grid(args)
+    elif overlap:
+        if args.pair_output is not None and (
+                args.report != "intersection" or len(args.db) != 1):
+            parser.error("--pair-output needs --report intersection and a single --db")
+        find_all_common_overlap(args)
+    else:
+        find_all_common_bed(args)
+
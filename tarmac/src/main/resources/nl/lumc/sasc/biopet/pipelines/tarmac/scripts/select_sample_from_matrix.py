@@ -19,37 +19,74 @@
 
 import argparse
 
-def xhmm_region_to_bed(region):
-    """Convert xhmm-style region to bed-style region."""
+import biopet_io
+import biopet_runtime
+
+def xhmm_region(region):
+    """Split an xhmm-style region into (chromosome, start, end)."""
     chromosome, interval = region.split(':')
     start, end = interval.split('-')
-    return "{0}\t{1}\t{2}".format(chromosome, start, end)
+    return chromosome, start, end
+
+def xhmm_region_to_bed(region):
+    """Convert xhmm-style region to bed-style region."""
+    return "{0}\t{1}\t{2}".format(*xhmm_region(region))
 
 if __name__ == "__main__":
     desc = """
     Extract a sample from an XHMM-style matrix.
     Will print (to stdout) a four-column bed file,
-    where the fourth column is the data field.
+    where the fourth column is the data field,
+    or write a region-grid values file (see biopet_grid.py).
     """
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument('-I', '--input', required=True, type=str, 
             help='Path to input matrix')
     parser.add_argument('-s', '--sample', required=True, type=str,
             help='Sample name to be extracted')
+    parser.add_argument('-o', '--output', default='-', type=str,
+            help='Output bed file, BGZF compressed when ending in .gz '
+                 '(default: stdout)')
+    parser.add_argument('--bgzf', action='store_true',
+            help='Always write BGZF compressed output')
+    parser.add_argument('--grid', type=str,
+            help='Region table of the matrix; written when it does not exist '
+                 'yet, otherwise checked against the matrix')
+    parser.add_argument('--output-format', choices=['bed', 'grid'], default='bed',
+            help='Write a bed file or a region-grid values file; the latter '
+                 'requires --grid (default: %(default)s)')
     args = parser.parse_args()
+    if args.output_format == 'grid' and args.grid is None:
+        parser.error('--output-format grid requires --grid')
+    biopet_runtime.init(__file__)
 
     values = None
 
-    with open(args.input) as handle:
+    with biopet_io.open_input(args.input) as handle:
         header = next(handle).strip().split('\t')[1:]
-        regions = [xhmm_region_to_bed(x) for x in header]
         for line in handle:
             if line.startswith(args.sample):
                 values = line.strip().split('\t')[1:]
                 break
-    if values is not None:
-        for reg, val in zip(regions, values):
-            print(reg+'\t'+val)
-    else:
+    if values is None:
         raise ValueError('sample {0} does not exist'.format(args.sample))
+    biopet_runtime.add_records(len(values))
+
+    if args.grid is not None:
+        import biopet_grid
+        grid = biopet_grid.load_or_store_grid(
+            biopet_grid.RegionGrid.from_regions(xhmm_region(x) for x in header),
+            args.grid)
+
+    if args.output_format == 'grid':
+        import numpy as np
+        biopet_grid.GridValues(grid.digest,
+                               np.array(values).astype(biopet_grid.VALUE_DTYPE),
+                               np.ones(len(values), dtype=bool),
+                               name=args.sample).write(args.output)
+    else:
+        regions = [xhmm_region_to_bed(x) for x in header]
+        with biopet_io.open_output(args.output, bgzf=args.bgzf or None) as out:
+            for reg, val in zip(regions, values):
+                out.write(reg+'\t'+val+'\n')
 
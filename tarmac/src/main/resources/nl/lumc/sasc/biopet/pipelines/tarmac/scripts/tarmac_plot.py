@@ -16,36 +16,104 @@
 # license, please contact us to obtain a separate license.
 #
 import argparse
+import hashlib
+import json
 
-import matplotlib as mpl
-
-mpl.use('Agg')
-import matplotlib.pyplot as plt
 import pysam
 
-from os.path import join, isdir
-from os import makedirs
+import biopet_io
+import biopet_runtime
+
+from os.path import join, isdir, isfile, basename
+from os import makedirs, remove, rename
 import sys
 
+MANIFEST_NAME = "plot_manifest.json"
+# part of every plot digest; bump when the look of the plots changes in a
+# way a change of this script's source does not capture (e.g. a matplotlib
+# style upgrade)
+PLOT_VERSION = "1"
+# consolidated outputs, holding all calls in a single file
+PDF_NAME = "calls.pdf"
+DATA_NAME = "calls.json.gz"
+
 
 def get_middle_pos(record):
     x = (int(record[2]) - int(record[1])) // 2
     return int(record[1]) + x
 
 
-def plot_call(chrom, start, end, whandle, xhandle, shandle, margin, output_loc):
-    s_records = list(shandle.fetch(chrom, start - margin, end + margin))
-    w_records = list(whandle.fetch(chrom, start - margin, end + margin))
-    x_records = list(xhandle.fetch(chrom, start - margin, end + margin))
+def fetch_records(handle, chrom, start, end, margin):
+    return list(handle.fetch(chrom, max(0, start - margin), end + margin))
+
+
+def renderer_id():
+    """
+    Identifies the plot code: PLOT_VERSION and a digest of the source of
+    this script, so cached plots are redone when the code changes
+    """
+    path = __file__[:-1] if __file__.endswith((".pyc", ".pyo")) else __file__
+    loader = globals().get("__loader__")
+    try:
+        if hasattr(loader, "get_data"):
+            # also works when run from the bundle archive
+            source = loader.get_data(path)
+        else:
+            with open(path, "rb") as handle:
+                source = handle.read()
+    except (IOError, OSError):
+        source = b""
+    return "{0}:{1}".format(PLOT_VERSION, hashlib.sha1(source).hexdigest())
+
+
+def call_hash(chrom, start, end, margin, s_records, w_records, x_records,
+              renderer=""):
+    """
+    Hash everything that ends up in the plot of a single call:
+    the renderer, the call coordinates, the margin and the fetched track
+    slices
+    """
+    h = hashlib.sha1()
+    h.update("{0}\n".format(renderer).encode())
+    h.update("{0}\t{1}\t{2}\t{3}\n".format(chrom, start, end, margin).encode())
+    for records in (s_records, w_records, x_records):
+        h.update(b">\n")
+        for record in records:
+            h.update("\t".join(record[:4]).encode())
+            h.update(b"\n")
+    return h.hexdigest()
+
+
+def read_manifest(path):
+    if not isfile(path):
+        return {}
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except ValueError:
+        # a truncated manifest from an aborted run; re-plot everything
+        return {}
 
-    s_x = [get_middle_pos(x) for x in s_records]
-    s_y = list(map(float, [x[3] for x in s_records]))
 
-    w_x = [get_middle_pos(x) for x in w_records]
-    w_y = list(map(float, [x[3] for x in w_records]))
+def write_manifest(path, manifest):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as handle:
+        json.dump(manifest, handle, sort_keys=True, indent=1)
+    rename(tmp, path)
 
-    x_x = [get_middle_pos(x) for x in x_records]
-    x_y = list(map(float, [x[3] for x in x_records]))
+
+def track(records):
+    """Middle positions and values of a track slice."""
+    return ([get_middle_pos(x) for x in records],
+            list(map(float, [x[3] for x in records])))
+
+
+def draw_call(chrom, s_records, w_records, x_records):
+    plt = biopet_runtime.pyplot()
+
+    s_x, s_y = track(s_records)
+    w_x, w_y = track(w_records)
+    x_x, x_y = track(x_records)
 
     figure = plt.figure(figsize=(11, 6))
     figure.add_subplot(111)
@@ -58,11 +126,71 @@ def plot_call(chrom, start, end, whandle, xhandle, shandle, margin, output_loc):
     plt.ylabel("Z-score")
     plt.xlabel("Position along {0}".format(chrom))
     plt.legend()
-    plt.savefig(output_loc, dpi=300)
+    return figure
+
+
+def close_figure(figure):
+    plt = biopet_runtime.pyplot()
     plt.cla()
     plt.close(figure)
 
 
+def plot_call(chrom, s_records, w_records, x_records, output_loc):
+    figure = draw_call(chrom, s_records, w_records, x_records)
+    figure.savefig(output_loc, dpi=300)
+    close_figure(figure)
+
+
+class PdfWriter(object):
+    """Writes every call as a (vector) page of a single pdf."""
+
+    def __init__(self, path):
+        from matplotlib.backends.backend_pdf import PdfPages
+        biopet_runtime.pyplot()
+        self.pages = PdfPages(path)
+
+    def write(self, chrom, start, end, s_records, w_records, x_records):
+        figure = draw_call(chrom, s_records, w_records, x_records)
+        figure.suptitle("{0}:{1}-{2}".format(chrom, start, end))
+        # the page is written out right away, only one figure is kept in memory
+        self.pages.savefig(figure)
+        close_figure(figure)
+
+    def close(self):
+        self.pages.close()
+
+
+class DataWriter(object):
+    """
+    Writes every call as one JSON line to a gzip file, with the positions
+    and values of each track, for plotting elsewhere.
+    """
+
+    def __init__(self, path):
+        self.handle = biopet_io.open_output(path, bgzf=True)
+
+    def write(self, chrom, start, end, s_records, w_records, x_records):
+        record = {"chrom": chrom, "start": start, "end": end}
+        for name, records in (("stouffer", s_records), ("wisecondor", w_records),
+                              ("xhmm", x_records)):
+            record[name] = dict(zip(("x", "y"), track(records)))
+        self.handle.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self.handle.close()
+
+
+def iter_calls(c_handle, s_handle, w_handle, x_handle, margin):
+    """Yield (chrom, start, end, s_records, w_records, x_records) per call."""
+    for contig in c_handle.contigs:
+        for call in c_handle.fetch(contig):
+            chrom, start, end = call[0], int(call[1]), int(call[2])
+            yield (chrom, start, end,
+                   fetch_records(s_handle, chrom, start, end, margin),
+                   fetch_records(w_handle, chrom, start, end, margin),
+                   fetch_records(x_handle, chrom, start, end, margin))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--calls", required=True)
@@ -71,11 +199,21 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--stouff-file", required=True)
     parser.add_argument("-m", "--margin", type=int, default=5000)
     parser.add_argument("-o", "--output-dir", required=True)
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-plot calls whose inputs changed since "
+                             "the previous run, and remove stale plots")
+    parser.add_argument("--output-mode", choices=["png", "pdf", "data"],
+                        default="png",
+                        help="png: one 300 dpi png per call; pdf: all calls as "
+                             "pages of a single {0}; data: the plotted values "
+                             "of all calls as JSON lines in a single {1} "
+                             "(default: %(default)s)".format(PDF_NAME, DATA_NAME))
 
     args = parser.parse_args()
+    biopet_runtime.init(__file__)
 
     if sys.version_info[0] == 3:
-        makedirs(args.output_dir, exists_ok=True)
+        makedirs(args.output_dir, exist_ok=True)
     elif sys.version_info[0] == 2:
         try:
             makedirs(args.output_dir)
@@ -88,12 +226,49 @@ if __name__ == "__main__":
     w_handle = pysam.TabixFile(args.wisecondor_file, parser=pysam.asTuple())
     x_handle = pysam.TabixFile(args.xhmm_file, parser=pysam.asTuple())
 
-    contigs = c_handle.contigs
-    for contig in contigs:
+    def calls():
+        return iter_calls(c_handle, s_handle, w_handle, x_handle, args.margin)
 
-        for call in c_handle.fetch(contig):
-            chrom, start, end, _ = call
+    manifest_path = join(args.output_dir, MANIFEST_NAME)
+    old_manifest = read_manifest(manifest_path) if args.incremental else {}
+    new_manifest = {}
+    renderer = renderer_id()
+
+    if args.output_mode == "png":
+        for chrom, start, end, s_records, w_records, x_records in calls():
             ofile = join(args.output_dir, "{0}_{1}-{2}.png".format(chrom, start, end))
-            plot_call(chrom, int(start), int(end), whandle=w_handle,
-                      shandle=s_handle, xhandle=x_handle,
-                      output_loc=ofile, margin=args.margin)
+            key = basename(ofile)
+            digest = call_hash(chrom, start, end, args.margin,
+                               s_records, w_records, x_records, renderer)
+            new_manifest[key] = digest
+            biopet_runtime.add_records()
+            if old_manifest.get(key) == digest and isfile(ofile):
+                continue
+            plot_call(chrom, s_records=s_records, w_records=w_records,
+                      x_records=x_records, output_loc=ofile)
+    else:
+        key = PDF_NAME if args.output_mode == "pdf" else DATA_NAME
+        ofile = join(args.output_dir, key)
+        # the single output file covers all calls, so its digest does as well;
+        # hashing is cheap next to plotting, so this is a separate pass
+        digest = hashlib.sha1()
+        for chrom, start, end, s_records, w_records, x_records in calls():
+            digest.update(call_hash(chrom, start, end, args.margin,
+                                    s_records, w_records, x_records,
+                                    renderer).encode())
+            biopet_runtime.add_records()
+        new_manifest[key] = digest.hexdigest()
+        if old_manifest.get(key) != new_manifest[key] or not isfile(ofile):
+            tmp = ofile + ".tmp"
+            writer = PdfWriter(tmp) if args.output_mode == "pdf" else DataWriter(tmp)
+            for call in calls():
+                writer.write(*call)
+            writer.close()
+            rename(tmp, ofile)
+
+    if args.incremental:
+        for key in set(old_manifest) - set(new_manifest):
+            stale = join(args.output_dir, key)
+            if isfile(stale):
+                remove(stale)
+    write_manifest(manifest_path, new_manifest)
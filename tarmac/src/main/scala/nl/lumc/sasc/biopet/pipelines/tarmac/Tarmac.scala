@@ -2,7 +2,7 @@ package nl.lumc.sasc.biopet.pipelines.tarmac
 
 import nl.lumc.sasc.biopet.core.summary.SummaryQScript
 import nl.lumc.sasc.biopet.core._
-import nl.lumc.sasc.biopet.extensions.bedtools.{BedtoolsIntersect, BedtoolsSort}
+import nl.lumc.sasc.biopet.extensions.bedtools.BedtoolsSort
 import nl.lumc.sasc.biopet.extensions.gatk.DepthOfCoverage
 import nl.lumc.sasc.biopet.extensions.stouffbed.{StouffbedHorizontal, StouffbedVertical}
 import nl.lumc.sasc.biopet.extensions.wisecondor.{
@@ -44,6 +44,9 @@ class Tarmac(val parent: Configurable)
   lazy val stouffWindowSizes: List[Int] = config("stouff_window_size")
   lazy val threshold: Int = config("threshold")
 
+  /** Minimum overlap of the wisecondor and xhmm regions, as fraction of the region */
+  lazy val syncMinOverlap: Option[Double] = config("sync_min_overlap")
+
   def this() = this(null)
 
   private var _finalFiles: Map[Sample, List[File]] = Map()
@@ -114,32 +117,27 @@ class Tarmac(val parent: Configurable)
         sample -> createXhmmZscore(sample, jobsAndRefFile._2)
     }
 
-    val wisecondorSyncJobs = wisecondorZJobs map {
+    // aligns the wisecondor and xhmm z-scores on their overlapping parts in one pass,
+    // both outputs hold the same regions in the same order
+    val zScoreSyncJobs = wisecondorZJobs map {
       case (sample, job) =>
-        val intersect = new BedtoolsIntersect(this)
-        intersect.input = job.output
-        intersect.intersectFile = xhmmZJobs(sample)._2
-        intersect.output =
-          new File(sample.wisecondorDir, s"${sample.sampleId}.wisecondor.sync.z.bed")
-        sample -> intersect
-    }
-
-    val xhmmSyncJobs = xhmmZJobs map {
-      case (sample, jobsAndFile) =>
-        val intersect = new BedtoolsIntersect(this)
-        intersect.input = jobsAndFile._2
-        intersect.intersectFile = wisecondorZJobs(sample).output
-        intersect.output = new File(sample.xhmmDir, s"${sample.sampleId}.xhmm.sync.z.bed")
-        sample -> intersect
+        val sync = new FindAllCommon(this)
+        sync.inputFile = job.output
+        sync.databases = List(xhmmZJobs(sample)._2)
+        sync.overlap = true
+        sync.minOverlap = syncMinOverlap
+        sync.report = Some("intersection")
+        sync.output =
+          Some(new File(sample.wisecondorDir, s"${sample.sampleId}.wisecondor.sync.z.bed"))
+        sync.pairOutput = Some(new File(sample.xhmmDir, s"${sample.sampleId}.xhmm.sync.z.bed"))
+        sync.isIntermediate = true
+        sample -> sync
     }
 
     val zScoreMergeJobs = samples map {
       case (_, sample) =>
         val horizontal = new StouffbedHorizontal(this)
-        val inputs = List(
-          wisecondorSyncJobs(sample).output,
-          xhmmSyncJobs(sample).output
-        )
+        val inputs = List(zScoreSyncJobs(sample).output, zScoreSyncJobs(sample).pairOutput).flatten
         horizontal.inputFiles = inputs
         horizontal.output = new File(sample.sampleDir, s"${sample.sampleId}.horizontal.bed")
         sample -> horizontal
@@ -264,8 +262,7 @@ class Tarmac(val parent: Configurable)
     addAll(wisecondorRefJobs.values.flatMap(_._1))
     addAll(xhmmZJobs.values.flatMap(_._1))
     addAll(wisecondorZJobs.values)
-    addAll(wisecondorSyncJobs.values)
-    addAll(xhmmSyncJobs.values)
+    addAll(zScoreSyncJobs.values)
     addAll(zScoreMergeJobs.values)
     addAll(windowStouffJobs.values.flatMap(_.values))
     addAll(thresholdJobs.values.flatMap(_.values))
@@ -4,7 +4,7 @@ import java.io.File
 
 import nl.lumc.sasc.biopet.core.extensions.PythonCommandLineFunction
 import nl.lumc.sasc.biopet.utils.config.Configurable
-import org.broadinstitute.gatk.utils.commandline.{Input, Output}
+import org.broadinstitute.gatk.utils.commandline.{Argument, Input, Output}
 
 /**
   * Created by Sander Bollen on 23-6-17.
@@ -21,10 +21,30 @@ class FindAllCommon(val parent: Configurable) extends PythonCommandLineFunction
   @Output(required = false)
   var output: Option[File] = None
 
+  /** Db records of the intersection parts, aligned with output; needs a single database */
+  @Output(required = false)
+  var pairOutput: Option[File] = None
+
+  /** Match regions that overlap, instead of regions with identical coordinates */
+  @Argument(required = false)
+  var overlap: Boolean = false
+
+  /** Minimum overlap with every database, as fraction of the input region */
+  @Argument(required = false)
+  var minOverlap: Option[Double] = None
+
+  /** Write the input records ("input") or only their overlapping parts ("intersection") */
+  @Argument(required = false)
+  var report: Option[String] = None
+
   def cmdLine: String = {
     getPythonCommand +
       required("--input", inputFile) +
       repeat("--db", databases) +
+      conditional(overlap, "--overlap") +
+      optional("--min-overlap", minOverlap) +
+      optional("--report", report) +
+      optional("--pair-output", pairOutput) +
       (if (outputAsStdout) "" else " > " + required(output))
   }
 
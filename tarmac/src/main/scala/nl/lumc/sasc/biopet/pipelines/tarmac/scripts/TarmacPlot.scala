@@ -26,6 +26,11 @@ class TarmacPlot(val parent: Configurable) extends PythonCommandLineFunction {
 
   var margin: Int = config("plot_margin", namespace = "tarmac", default = 5000)
 
+  var incremental: Boolean = config("plot_incremental", namespace = "tarmac", default = false)
+
+  /** png (one file per call), pdf (one multi-page file) or data (one JSON lines file) */
+  var outputMode: Option[String] = config("plot_output_mode", namespace = "tarmac")
+
   @Output
   var outputDir: File = _
 
@@ -36,7 +41,9 @@ class TarmacPlot(val parent: Configurable) extends PythonCommandLineFunction {
       required("-s", stouffFile) +
       required("-x", xhmmFile) +
       required("-m", margin) +
-      required("-o", outputDir)
+      required("-o", outputDir) +
+      conditional(incremental, "--incremental") +
+      optional("--output-mode", outputMode)
   }
 
 }